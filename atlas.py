@@ -0,0 +1,109 @@
+"""
+シューティングこうかとんのスプライト画像をアトラスにまとめるビルド手順
+fig/内のスプライト（背景のJPEG以外）を数枚のアトラス画像に詰め込み，各画像の位置をJSONの索引に書き出す
+索引（fig/atlas.json）があればゲームはアトラスを1回ずつデコードし，各スプライトをそのsubsurfaceとして使う
+索引がなければ（または索引にない画像は）従来どおりファイルごとに読み込む
+索引には元のファイルのバイト数と更新時刻も書いておき，アトラスを作った後に変わった画像は元のファイルから読み込む
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame as pg
+
+import shootinggame_koukaton as game
+
+
+def sprite_names(root: str) -> list[str]:
+    """
+    アトラスにまとめる画像ファイル名のリスト（ゲームで使う画像と番号付きのこうかとん，JPEGは写真なので除く）
+    引数 root：画像のディレクトリ
+    """
+    names = game.image_manifest()
+    names += [os.path.basename(path) for path in sorted(glob.glob(f"{root}/[0-9]*.png"))]
+    return [name for name in dict.fromkeys(names) if not name.endswith(".jpg")]
+
+
+def pack(sizes: dict[str, tuple[int, int]], width: int,
+         padding: int) -> tuple[dict[str, tuple[int, int]], tuple[int, int]]:
+    """
+    画像を高さの順に棚（行）へ左から詰める
+    引数1 sizes：ファイル名 -> (幅, 高さ)
+    引数2 width：アトラスの最大の幅
+    引数3 padding：画像の間の余白[px]
+    戻り値：(ファイル名 -> 左上の座標, 使った(幅, 高さ))
+    """
+    positions = {}
+    x = y = shelf = right = 0  # 今の棚の左端からの位置，棚の上端，棚の高さ，使った幅
+    for name in sorted(sizes, key=lambda name: (-sizes[name][1], name)):
+        w, h = sizes[name]
+        if w > width:
+            raise ValueError(f"{name} is wider than the atlas ({w} > {width})")
+        if x + w > width:  # 次の棚へ
+            x, y, shelf = 0, y + shelf + padding, 0
+        positions[name] = (x, y)
+        right = max(right, x + w)
+        x += w + padding
+        shelf = max(shelf, h)
+    return positions, (right, y + shelf)
+
+
+def build(root: str = "fig", width: int = 1024, padding: int = 1) -> dict:
+    """
+    アトラス画像と索引を作ってrootに書き出す
+    透明度を持つ画像と透明色（colorkey）を持つ画像は，ゲームでの変換方法が違うので別のアトラスにする
+    引数1 root：画像のディレクトリ
+    引数2 width：アトラスの最大の幅
+    引数3 padding：画像の間の余白[px]
+    戻り値：索引
+    """
+    cache = game.ImageCache(root)
+    imgs = {name: pg.image.load(f"{root}/{name}") for name in sprite_names(root)}
+    groups = {
+        "atlas_alpha.png": [name for name, img in imgs.items() if img.get_colorkey() is None],
+        "atlas_colorkey.png": [name for name, img in imgs.items() if img.get_colorkey() is not None],
+    }
+    index = {"pages": [], "sprites": {}}
+    for page, names in groups.items():
+        if not names:
+            continue
+        positions, size = pack({name: imgs[name].get_size() for name in names}, width, padding)
+        alpha = page == "atlas_alpha.png"
+        atlas = pg.Surface(size, pg.SRCALPHA if alpha else 0, 32)
+        for name in names:
+            img = imgs[name]
+            if not alpha:
+                img = img.copy()
+                img.set_colorkey(None)  # 透明色の画素もそのままの色で写す
+            atlas.blit(img, positions[name])
+            sprite = {"page": page, "rect": [*positions[name], *img.get_size()], "source": cache.source(name)}
+            if not alpha:
+                sprite["colorkey"] = list(imgs[name].get_colorkey()[:3])
+            index["sprites"][name] = sprite
+        pg.image.save(atlas, f"{root}/{page}")
+        index["pages"].append(page)
+    with open(f"{root}/{game.ImageCache.index_name}", "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スプライト画像をアトラスにまとめる")
+    parser.add_argument("--root", default="fig", help="画像のディレクトリ")
+    parser.add_argument("--width", type=int, default=1024, help="アトラスの幅[px]")
+    parser.add_argument("--padding", type=int, default=1, help="画像の間の余白[px]")
+    args = parser.parse_args()
+    pg.init()
+    index = build(args.root, args.width, args.padding)
+    sources = sum(os.path.getsize(f"{args.root}/{name}") for name in index["sprites"])
+    pages = sum(os.path.getsize(f"{args.root}/{page}") for page in index["pages"])
+    print(f"{len(index['sprites'])} sprites in {len(index['pages'])} atlases: "
+          f"{sources} bytes -> {pages} bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+シューティングこうかとんのバランス調整・負荷試験用のバッチ実行
+画面なしのゲームをシードを変えて何本も，全コアのプロセスプールで並列に実行し，
+World.balanceの値を振ったときの生存時間・スコア・jewel数・フレーム時間を1つのレポートにまとめる
+"""
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame as pg
+
+import shootinggame_koukaton as game
+from benchmark import git_commit, percentile
+
+
+class IdlePolicy:
+    """
+    何も入力しない
+    """
+    def __init__(self, seed: int):
+        self.keys = collections.defaultdict(bool)
+
+    def __call__(self, world: game.World) -> tuple[dict, list]:
+        return self.keys, []
+
+
+class RandomPolicy:
+    """
+    矢印キーをランダムな時間押し続け，一定間隔でビームを撃つ
+    """
+    def __init__(self, seed: int):
+        """
+        引数 seed：入力用の乱数シード（ゲームの乱数とは別）
+        """
+        self.rng = random.Random(seed)
+        self.keys = collections.defaultdict(bool)
+        self.hold = 0  # 今のキーを押し続ける残りフレーム数
+
+    def __call__(self, world: game.World) -> tuple[dict, list]:
+        if self.hold <= 0:
+            for key in (pg.K_UP, pg.K_DOWN, pg.K_LEFT, pg.K_RIGHT):
+                self.keys[key] = self.rng.random() < 0.3
+            self.hold = self.rng.randint(5, 30)
+        self.hold -= 1
+        return self.keys, shoot(world.tmr)
+
+
+class DodgePolicy:
+    """
+    ビームを撃ち続けながら，近づく壁の隙間に向かい，近くの爆弾から上下に逃げる
+    """
+    def __init__(self, seed: int):
+        self.keys = collections.defaultdict(bool)
+
+    def __call__(self, world: game.World) -> tuple[dict, list]:
+        bird = world.bird.rect
+        target = None  # 目標のy座標
+        walls = [wall for wall in world.obstacles if wall.rect.right > bird.left and wall.rect.left - bird.right < 400]
+        if walls:
+            wall = min(walls, key=lambda wall: wall.rect.left)
+            gap = [y for y in range(25, game.HEIGHT, game.ObstacleWall.size) if y not in wall.tiles]
+            target = sum(gap) / len(gap)
+        else:
+            near = [rect for rect in world.bombs.rects() if abs(rect.centerx - bird.centerx) < 200]
+            if near:
+                bomb = min(near, key=lambda rect: abs(rect.centery - bird.centery))
+                if abs(bomb.centery - bird.centery) < 100:
+                    target = bird.centery + (100 if bomb.centery <= bird.centery else -100)
+        self.keys[pg.K_UP] = target is not None and target < bird.centery - 5
+        self.keys[pg.K_DOWN] = target is not None and target > bird.centery + 5
+        return self.keys, shoot(world.tmr)
+
+
+def shoot(tmr: int) -> list[pg.event.Event]:
+    """
+    10フレームごとにスペースキーを押して離し，通常のビームを撃つイベントを返す
+    """
+    if tmr % 10 == 0:
+        return [pg.event.Event(pg.KEYDOWN, key=pg.K_SPACE)]
+    if tmr % 10 == 1:
+        return [pg.event.Event(pg.KEYUP, key=pg.K_SPACE)]
+    return []
+
+
+POLICIES = {"idle": IdlePolicy, "random": RandomPolicy, "dodge": DodgePolicy}
+
+
+def init_worker():
+    """
+    プロセスごとに一度だけpygameを初期化し，画像を読み込んでおく
+    """
+    pg.init()
+    pg.display.set_mode((game.WIDTH, game.HEIGHT))
+    game.preload_images()
+
+
+def play(job: dict) -> dict:
+    """
+    1ゲームを画面なしで最後まで（または最大フレーム数まで）実行する
+    引数 job：{"balance", "seed", "policy", "frames", "broadphase", "bombs", "level", "precise"}
+    戻り値：1ゲームの結果
+    """
+    policy = POLICIES[job["policy"]](job["seed"])
+    frame_ms = []
+    world = game.run_headless(job["frames"], policy, job["seed"], job["broadphase"], job["bombs"],
+                              job["balance"], frame_ms, job["level"], job["precise"])
+    return {
+        "balance": job["balance"],
+        "seed": job["seed"],
+        "result": world.result or "timeout",
+        "frames": world.tmr,
+        "score": world.score.value,
+        "jewels": world.cpoint,
+        "hp": world.bird.hp.current_hp,
+        "hits": dict(world.hits),
+        "frame_ms": frame_ms,
+    }
+
+
+def summarize(games: list[dict]) -> dict:
+    """
+    同じパラメータで実行したゲームの結果をまとめる
+    """
+    frames = [g["frames"] for g in games]
+    times = sorted(ms for g in games for ms in g["frame_ms"])
+    results = collections.Counter(g["result"] for g in games)
+    return {
+        "games": len(games),
+        "results": dict(results),
+        "survival_s_mean": statistics.mean(frames) / game.TICK_RATE,
+        "survival_s_median": statistics.median(frames) / game.TICK_RATE,
+        "score_mean": statistics.mean(g["score"] for g in games),
+        "jewels_mean": statistics.mean(g["jewels"] for g in games),
+        "hits_mean": {kind: statistics.mean(g["hits"].get(kind, 0) for g in games)
+                      for kind in ("bombs", "obstacles", "items", "jewels")},
+        "frame_ms_mean": statistics.mean(times) if times else 0.0,
+        "frame_ms_p95": percentile(times, 95) if times else 0.0,
+        "frame_ms_p99": percentile(times, 99) if times else 0.0,
+        "frame_ms_max": times[-1] if times else 0.0,
+    }
+
+
+def parse_sweep(spec: str) -> tuple[str, list]:
+    """
+    "名前=値,値,..."を(名前, 値のリスト)にする（範囲の値は"50:300"のように書く）
+    """
+    name, _, values = spec.partition("=")
+    if name not in game.World.balance or not values:
+        raise argparse.ArgumentTypeError(f"expected NAME=V1,V2,... with NAME in {', '.join(game.World.balance)}")
+    parsed = []
+    for value in values.split(","):
+        if ":" in value:
+            parsed.append(tuple(int(v) for v in value.split(":")))
+        else:
+            parsed.append(float(value) if "." in value else int(value))
+    return name, parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="シューティングこうかとんのバッチ実行（バランス調整・負荷試験）")
+    parser.add_argument("--sweep", type=parse_sweep, action="append", default=[], metavar="NAME=V1,V2",
+                        help=f"振るパラメータ（複数指定で全組み合わせ）：{', '.join(game.World.balance)}")
+    parser.add_argument("--games", type=int, default=8, help="パラメータの組ごとのゲーム数（シードを変える）")
+    parser.add_argument("--frames", type=int, default=3000, help="1ゲームの最大フレーム数")
+    parser.add_argument("--policy", choices=POLICIES, default="dodge", help="入力の与え方")
+    parser.add_argument("--seed", type=int, default=0, help="最初のゲームの乱数シード")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="並列に実行するプロセス数")
+    parser.add_argument("--broadphase", choices=game.BROADPHASES, default="grid", help="衝突判定のブロードフェーズ")
+    parser.add_argument("--bombs", choices=game.BOMB_ENGINES, default="array", help="爆弾の管理方式")
+    parser.add_argument("--level", metavar="FILE", help="出現ルールを定めるレベルファイル（JSON）")
+    parser.add_argument("--precise", action="store_true", help="画素単位の衝突判定を使う")
+    parser.add_argument("--out", metavar="FILE", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+    ignored = [name for name, _ in args.sweep if name in game.World.spawn_balance]
+    if args.level and ignored:
+        parser.error(f"--sweep {', '.join(ignored)} has no effect with --level (spawns come from the level's waves)")
+
+    level = game.load_level(args.level) if args.level else None
+    names = [name for name, _ in args.sweep]
+    combos = [dict(zip(names, values)) for values in itertools.product(*(values for _, values in args.sweep))]
+    jobs = [{"balance": balance, "seed": args.seed + i, "policy": args.policy, "frames": args.frames,
+             "broadphase": args.broadphase, "bombs": args.bombs, "level": level,
+             "precise": args.precise}
+            for balance in combos for i in range(args.games)]
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=init_worker) as pool:
+        games = list(pool.map(play, jobs, chunksize=max(1, len(jobs) // (4 * args.workers))))
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pygame": pg.version.ver,
+        "policy": args.policy,
+        "games_per_combo": args.games,
+        "max_frames": args.frames,
+        "tick_rate": game.TICK_RATE,
+        "level": args.level,
+        "precise": args.precise,
+        "workers": args.workers,
+        "elapsed_s": elapsed,
+        "defaults": game.World.balance,
+        "combos": [],
+    }
+    for i, balance in enumerate(combos):
+        stats = summarize(games[i*args.games:(i+1)*args.games])
+        report["combos"].append({"balance": balance, **stats})
+        label = " ".join(f"{k}={v}" for k, v in balance.items()) or "defaults"
+        print(f"{label:40s} survival={stats['survival_s_mean']:6.1f}s score={stats['score_mean']:7.1f} "
+              f"jewels={stats['jewels_mean']:4.2f} results={stats['results']} "
+              f"frame p95={stats['frame_ms_p95']:.3f}ms")
+    print(f"{len(jobs)} games in {elapsed:.1f}s on {args.workers} workers")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,413 @@
+"""
+シューティングこうかとんのベンチマーク
+ダミーのビデオドライバで実行するので，ウィンドウのない環境でも動く
+各シナリオのフレーム時間（平均・p95・p99）と1フレームあたりのエンティティ数をJSONに出力する
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame as pg
+
+import shootinggame_koukaton as game
+
+
+def bench_bird_hyper(frames: int = 500, bucket: int = 50) -> list[float]:
+    """
+    無敵モード1回分（hyper_lifeが尽きるまで）のBird.updateの処理時間を計測する
+    引数1 frames：無敵モードのフレーム数
+    引数2 bucket：平均をとるフレーム数
+    戻り値：bucketごとの1フレームあたりの平均処理時間[ms]のリスト
+    """
+    screen = pg.display.set_mode((game.WIDTH, game.HEIGHT))
+    game.preload_images()
+    bird = game.Bird(3, (100, game.HEIGHT//2))
+    timers = game.TimerWheel()
+    bird.hyper(2*frames, timers)  # World.stepと違い1フレームに1回しか数えないので2倍にしておく
+    key_lst = collections.defaultdict(bool)  # どのキーも押されていない
+    costs = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        bird.update(key_lst)
+        timers.advance()
+        screen.blits(bird.blits(), doreturn=False)
+        costs.append(time.perf_counter()-start)
+    return [sum(costs[i:i+bucket])/len(costs[i:i+bucket])*1000 for i in range(0, frames, bucket)]
+
+
+def spawn_enemy(world: game.World, stopped: bool = False) -> game.Enemy:
+    """
+    敵機を出現させる
+    引数1 world：対象のWorld
+    引数2 stopped：Trueなら停止位置に置き，すぐに爆弾を投下させる
+    """
+    emy = game.Enemy(world.rng)
+    if stopped:
+        emy.rect.centerx = emy.bound - 1
+    world.emys.add(emy)
+    return emy
+
+
+def spawn_bombs(world: game.World, num: int):
+    """
+    画面右半分のランダムな位置からこうかとんに向けて爆弾を投下する
+    引数1 world：対象のWorld
+    引数2 num：爆弾の数
+    """
+    emy = game.Enemy(world.rng)
+    for _ in range(num):
+        emy.rect.center = world.rng.randint(game.WIDTH//2, game.WIDTH-60), world.rng.randint(60, game.HEIGHT-60)
+        world.bombs.spawn(emy, world.bird, world.rng)
+
+
+def spawn_beams(world: game.World, num: int):
+    """
+    画面内のランダムな位置に通常ビームを出現させる
+    引数1 world：対象のWorld
+    引数2 num：ビームの数
+    """
+    for _ in range(num):
+        beam = game.Beam.acquire(world.bird, False)
+        beam.rect.topleft = world.rng.randint(0, game.WIDTH-100), world.rng.randint(0, game.HEIGHT-30)
+        world.beams.add(beam)
+
+
+def tick_bombs_beams(num: int):
+    """
+    爆弾をnum個，ビームをnum/4個に保つ毎フレームの処理を返す（衝突判定のスケーリング計測用）
+    """
+    def tick(world: game.World):
+        spawn_bombs(world, num - len(world.bombs))
+        spawn_beams(world, num//4 - len(world.beams))
+    return tick
+
+
+def setup_stopped_enemies(world: game.World):
+    for _ in range(200):
+        spawn_enemy(world, stopped=True)
+
+
+def tick_bombs(num: int):
+    """
+    爆弾をnum個に保つ毎フレームの処理を返す（画面外に消えた分を補充する）
+    """
+    def tick(world: game.World):
+        spawn_bombs(world, num - len(world.bombs))
+    return tick
+
+
+def tick_obstacle_walls(world: game.World):
+    if world.tmr % 10 == 0:
+        world.obstacles.add(game.create_obstacle_wall(world.rng))
+
+
+def tick_gravity_emp_storm(world: game.World):
+    for _ in range(5):
+        spawn_enemy(world)
+    spawn_bombs(world, 20)
+    if world.tmr % 20 == 0:
+        world.gravity_group.add(game.Gravity(400, world.timers))
+        world.emps.add(game.EMP(world.bird, world.bombs, world.emys, world.timers))
+
+
+def tick_guided_beams(world: game.World):
+    while len(world.emys) < 20:
+        spawn_enemy(world)
+    for _ in range(50 - len(world.beams)):
+        world.beams.add(game.GuidedBeam(world.bird, world.emys))
+
+
+# シナリオ名 -> (開始時の準備, 毎フレームの追加処理)
+SCENARIOS = {
+    "baseline": (None, None),
+    "stopped_enemies_200": (setup_stopped_enemies, None),
+    "bombs_2000": (None, tick_bombs(2000)),
+    "bombs_10000": (None, tick_bombs(10000)),
+    "obstacle_walls": (None, tick_obstacle_walls),
+    "gravity_emp_storm": (None, tick_gravity_emp_storm),
+    "guided_beams_50": (None, tick_guided_beams),
+    "bombs_beams_1000": (None, tick_bombs_beams(1000)),
+    "bombs_beams_2000": (None, tick_bombs_beams(2000)),
+    "bombs_beams_4000": (None, tick_bombs_beams(4000)),
+}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    昇順に並んだ値のpパーセンタイルを返す（最近傍法）
+    """
+    return sorted_values[min(len(sorted_values)-1, int(len(sorted_values) * p / 100))]
+
+
+def run_scenario(name: str, frames: int, draw: bool = True, seed: int = 0, broadphase: str = "grid",
+                 bombs: str = "array", precise: bool = False, dirty: bool = False,
+                 scroll: bool = True) -> dict:
+    """
+    シナリオを実行し，フレーム時間とエンティティ数の統計を返す
+    引数1 name：SCENARIOSのシナリオ名
+    引数2 frames：計測するフレーム数
+    引数3 draw：Falseならシミュレーションだけを計測する
+    引数4 seed：乱数シード
+    引数5 broadphase：衝突判定のブロードフェーズ
+    引数6 bombs：爆弾の管理方式
+    引数7 precise：Trueなら画素単位の衝突判定を使う
+    引数8 dirty：Trueなら変化した領域だけを画面に転送する
+    引数9 scroll：Falseなら背景をスクロールさせない（ダーティレクトの効果を比べるとき）
+    """
+    setup, tick = SCENARIOS[name]
+    screen = pg.display.set_mode((game.WIDTH, game.HEIGHT))
+    game.preload_images()
+    world = game.World(headless=not draw, scroll=scroll, seed=seed, broadphase=broadphase, bombs=bombs,
+                       precise=precise)
+    world.bird.hyper(10**9, world.timers)  # 計測中にゲームが終わらないよう無敵にしておく
+    updater = game.ScreenUpdater(dirty)
+    key_lst = collections.defaultdict(bool)
+    if setup is not None:
+        setup(world)
+    pools = game.SpritePool.stats()
+    cache = game.images.stats()  # preload後は読み込みもキャッシュミスも増えないはず
+    times, entities, blits, bg_pixels, areas = [], [], [], [], []
+    for _ in range(frames):
+        start = time.perf_counter()
+        if tick is not None:
+            tick(world)
+        world.step(key_lst, [])
+        if draw:
+            world.draw(screen, updater)
+            updater.flush(full=world.bg.scrolling)
+            blits.append(world.queue.count)
+            bg_pixels.append(world.bg.pixels)
+            areas.append(updater.area)
+        times.append((time.perf_counter()-start) * 1000)
+        entities.append(sum(world.entity_counts().values()))
+        if world.result is not None:
+            break
+    times.sort()
+    return {
+        "frames": len(times),
+        "mean_ms": sum(times) / len(times),
+        "p95_ms": percentile(times, 95),
+        "p99_ms": percentile(times, 99),
+        "max_ms": times[-1],
+        "entities_mean": sum(entities) / len(entities),
+        "entities_max": max(entities),
+        "blits_mean": sum(blits) / len(blits) if blits else 0,
+        "bg_pixels_mean": sum(bg_pixels) / len(bg_pixels) if bg_pixels else 0,
+        "area_mean": sum(areas) / len(areas) if areas else 0,  # 1フレームで画面に転送した面積[px]
+        "result": world.result,
+        "hits": dict(world.hits),
+        "hud": {"rebuilds": world.hud.rebuilds, "reuses": world.hud.reuses} if draw else None,
+        "images": {name: game.images.stats()[name] - cache[name] for name in ("loads", "misses")},
+        "pools": {name: {"hits": pool["hits"]-pools[name]["hits"], "misses": pool["misses"]-pools[name]["misses"]}
+                  for name, pool in game.SpritePool.stats().items()},
+    }
+
+
+def trace(frames: int = 1500, seed: int = 5, broadphase: str = "grid", bombs: str = "array") -> str:
+    """
+    爆弾・停止した敵機・jewelを足し続けながら決まった入力でゲームを進め，毎フレームの状態のハッシュを返す
+    衝突判定のブロードフェーズや爆弾の管理方式を変えても同じ値になるはず
+    引数1 frames：進めるフレーム数
+    引数2 seed：ゲームの乱数シード
+    引数3 broadphase：衝突判定のブロードフェーズ
+    引数4 bombs：爆弾の管理方式
+    """
+    pg.display.set_mode((game.WIDTH, game.HEIGHT))
+    game.preload_images()
+    world = game.World(headless=True, seed=seed, broadphase=broadphase, bombs=bombs)
+    world.bird.hyper(10**9, world.timers)  # 途中でゲームが終わらないよう無敵にしておく
+    for name in world.item_stock.items:
+        world.item_stock.items[name] = 50
+    rng = random.Random(1)  # 入力用の乱数（ゲームの乱数とは別）
+    digest = hashlib.sha1()
+    for tmr in range(frames):
+        key_lst = collections.defaultdict(bool)
+        for key in (pg.K_UP, pg.K_DOWN, pg.K_LEFT, pg.K_RIGHT):
+            key_lst[key] = rng.random() < 0.3
+        events = []
+        if rng.random() < 0.3:
+            events.append(pg.event.Event(pg.KEYDOWN, key=pg.K_SPACE))
+        if rng.random() < 0.3:
+            events.append(pg.event.Event(pg.KEYUP, key=pg.K_SPACE))
+        if rng.random() < 0.02:
+            events.append(pg.event.Event(pg.KEYDOWN, key=rng.choice([pg.K_s, pg.K_e, pg.K_RETURN, pg.K_LSHIFT])))
+        if tmr % 3 == 0:
+            spawn_bombs(world, 30)
+        if tmr % 20 == 0:
+            spawn_enemy(world, stopped=True)
+        if tmr % 40 == 0:
+            world.citem.add(game.Clear_item(world.rng))
+        world.step(key_lst, events)
+        rects = [tuple(rect) for rect in world.bombs.rects()]
+        rects += [tuple(sprite.rect) for group in (world.emys, world.beams, world.exps, world.obstacles)
+                  for sprite in group]
+        digest.update(repr((world.score.value, world.cpoint, sorted(rects))).encode())
+        if world.result is not None:
+            break
+    return digest.hexdigest()
+
+
+def verify_timer_wheel(frames: int = 50000, seed: int = 1) -> bool:
+    """
+    TimerWheelにタイマーの登録・取り消し・発火中の登録をランダムに行い，
+    各タイマーが毎フレーム1ずつ減らすカウンタと同じフレーム（登録時のフレーム+delay）に1回だけ発火するかを確かめる
+    引数1 frames：進めるフレーム数
+    引数2 seed：乱数シード
+    戻り値：すべてのタイマーが期待どおりに発火したらTrue
+    """
+    rng = random.Random(seed)
+    wheel = game.TimerWheel()
+    expected = {}  # タイマーの番号 -> 発火するはずのフレーム
+    fired = collections.defaultdict(list)  # タイマーの番号 -> 発火したフレームのリスト
+    timers = []
+    delays = [0, 1, 2, 63, 64, 65, 127, 128, 4095, 4096, 4097, 262143, 262144]
+
+    def schedule(delay: int):
+        number = len(timers)
+        expected[number] = wheel.frame + delay
+        timers.append(wheel.schedule(delay, fire, number))
+
+    def fire(number: int):
+        fired[number].append(wheel.frame)
+        if rng.random() < 0.3:  # 発火中に別のタイマーを登録する
+            schedule(rng.choice(delays + [rng.randrange(frames)]))
+
+    for _ in range(frames):
+        if rng.random() < 0.05:
+            for _ in range(rng.randint(1, 5)):
+                schedule(rng.choice(delays + [rng.randrange(2000), rng.randrange(frames)]))
+        if timers and rng.random() < 0.02:
+            number = rng.randrange(len(timers))
+            if timers[number].callback is not None:  # まだ発火していないタイマーを取り消す
+                timers[number].cancel()
+                del expected[number]
+        wheel.advance()
+    due = {number: [tick] for number, tick in expected.items() if tick < wheel.frame}
+    return dict(fired) == due
+
+
+def verify_profiler_toggle() -> bool:
+    """
+    --profileなしで作ったFrameProfilerを，フレームの途中（イベント取得中のF3キー）で表示・非表示に切り替えても
+    計測が続けられるかを確かめる
+    戻り値：オンにしたフレームから記録され，オフにすると記録をやめて履歴を捨てればTrue
+    """
+    profiler = game.FrameProfiler()
+    recorded = []
+    for toggle in (False, True, False, True):
+        profiler.begin()
+        if toggle:
+            profiler.toggle_overlay()
+        try:
+            for phase in game.FrameProfiler.phases:
+                profiler.mark(phase)
+        except KeyError:
+            return False
+        profiler.end({})
+        recorded.append(len(profiler.history))
+    return recorded == [0, 1, 2, 0]
+
+
+def verify(frames: int) -> bool:
+    """
+    衝突判定のブロードフェーズと爆弾の管理方式の組ごとにtrace()を実行し，すべて同じ結果になるかを確かめる
+    TimerWheelがフレームごとのカウンタと同じフレームにタイマーを発火させるか，FrameProfilerを途中で切り替えられるかも確かめる
+    引数 frames：進めるフレーム数
+    戻り値：すべて同じならTrue
+    """
+    digests = {}
+    for broadphase in game.BROADPHASES:
+        for bombs in game.BOMB_ENGINES:
+            digests[broadphase, bombs] = trace(frames, broadphase=broadphase, bombs=bombs)
+            print(f"{broadphase:6s} {bombs:6s} {digests[broadphase, bombs]}")
+    wheel_ok = verify_timer_wheel()
+    print("TimerWheel", "ok" if wheel_ok else "MISMATCHED")
+    profiler_ok = verify_profiler_toggle()
+    print("FrameProfiler toggle", "ok" if profiler_ok else "FAILED")
+    return len(set(digests.values())) == 1 and wheel_ok and profiler_ok
+
+
+def git_commit() -> str | None:
+    """
+    計測したコミットのハッシュを返す（gitがなければNone）
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="シューティングこうかとんのベンチマーク")
+    parser.add_argument("scenarios", nargs="*", help=f"実行するシナリオ（省略時はすべて）：{', '.join(SCENARIOS)}")
+    parser.add_argument("--frames", type=int, default=500, help="シナリオごとのフレーム数")
+    parser.add_argument("--no-draw", action="store_true", help="描画を行わずシミュレーションだけを計測する")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--broadphase", choices=game.BROADPHASES, default="grid", help="衝突判定のブロードフェーズ")
+    parser.add_argument("--bombs", choices=game.BOMB_ENGINES, default="array", help="爆弾の管理方式")
+    parser.add_argument("--precise", action="store_true", help="画素単位の衝突判定で計測する")
+    parser.add_argument("--dirty", action="store_true", help="変化した領域だけを画面に転送する")
+    parser.add_argument("--static-bg", action="store_true", help="背景をスクロールさせない")
+    parser.add_argument("--out", metavar="FILE", help="結果を書き出すJSONファイル")
+    parser.add_argument("--verify", action="store_true",
+                        help="ブロードフェーズや爆弾の管理方式を変えても同じゲームになるか，"
+                             "TimerWheelがカウンタと同じフレームに発火するかを確かめる（違えば終了コード1）")
+    parser.add_argument("--bird-hyper", action="store_true", help="無敵モード中のBird.updateの処理時間を計測する")
+    args = parser.parse_args()
+    pg.init()
+    if args.verify:
+        ok = verify(args.frames)
+        print("verify", "ok" if ok else "MISMATCHED")
+        pg.quit()
+        return 0 if ok else 1
+    if args.bird_hyper:
+        for i, ms in enumerate(bench_bird_hyper()):
+            print(f"Bird.update frames {i*50:3d}-{i*50+49:3d}: {ms:.4f} ms")
+        pg.quit()
+        return 0
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pygame": pg.version.ver,
+        "frames": args.frames,
+        "draw": not args.no_draw,
+        "broadphase": args.broadphase,
+        "bombs": args.bombs,
+        "precise": args.precise,
+        "dirty": args.dirty,
+        "scroll": not args.static_bg,
+        "scenarios": {},
+    }
+    for name in args.scenarios or SCENARIOS:
+        stats = run_scenario(name, args.frames, draw=not args.no_draw, seed=args.seed, broadphase=args.broadphase,
+                             bombs=args.bombs, precise=args.precise, dirty=args.dirty, scroll=not args.static_bg)
+        report["scenarios"][name] = stats
+        print(f"{name:22s} mean={stats['mean_ms']:7.3f}ms p95={stats['p95_ms']:7.3f}ms "
+              f"p99={stats['p99_ms']:7.3f}ms entities={stats['entities_mean']:8.1f} "
+              f"area={stats['area_mean']:9.0f}px hits={sum(stats['hits'].values())} "
+              f"image_loads={stats['images']['loads']} image_misses={stats['images']['misses']}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    pg.quit()
+    grown = [name for name, stats in report["scenarios"].items() if any(stats["images"].values())]
+    if grown:  # 計測中に画像を読み込んだ（preloadの漏れ）
+        print(f"error: images were loaded after preload in {', '.join(grown)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
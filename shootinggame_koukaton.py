@@ -1,18 +1,456 @@
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
+import heapq
+import itertools
+import json
 import math
 import os
 import random
 import sys
 import time
 import pygame as pg
+try:
+    import numpy as np
+except ImportError:  # NumPyがなければ爆弾はスプライトで管理する
+    np = None
 
 WIDTH = 1100  # ゲームウィンドウの幅
 HEIGHT = 650  # ゲームウィンドウの高さ
+TICK_RATE = 50  # 1秒あたりのシミュレーションの回数（移動量などはすべて1tickあたりの値）
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 
+class ImageCache:
+    """
+    fig/内の画像を一度だけ読み込み，変換・拡大縮小済みのSurfaceを共有するクラス
+    同じ引数で呼ばれたget()は常に同じSurfaceを返すため，共有先で書き換えないこと
+    atlas.pyで作ったアトラスの索引があれば，索引にある画像はアトラスのsubsurfaceとして返す
+    （アトラスのファイルがない画像や，アトラスを作った後に元のファイルが変わった画像は元のファイルから読み込む）
+    """
+    index_name = "atlas.json"  # アトラスの索引のファイル名
+
+    def __init__(self, root: str = "fig"):
+        self.root = root
+        self.surfaces = {}  # (ファイル名, size, zoom, angle, flip) -> Surface
+        self.masks = {}  # Surface -> 不透明な画素のMask
+        self.sprites = {}  # ファイル名 -> アトラス上の{"page", "rect", "colorkey", "source"}
+        self.pages = {}  # アトラスのファイル名 -> 変換済みのアトラスSurface
+        path = f"{root}/{__class__.index_name}"
+        if os.path.exists(path):
+            with open(path) as f:
+                sprites = json.load(f)["sprites"]
+            pages = {page for page in {sprite["page"] for sprite in sprites.values()}
+                     if os.path.exists(f"{root}/{page}")}
+            self.sprites = {name: sprite for name, sprite in sprites.items()
+                            if sprite["page"] in pages and sprite.get("source") == self.source(name)}
+        self.pending = {}  # ファイル名 -> スレッドプールでデコード中の画像のFuture
+        self.async_total = 0  # load_async()で読み込みを始めたファイルの数
+        self.load_count = 0  # ディスクから読み込んだ回数
+        self.misses = 0  # preload()後に発生したキャッシュミスの回数
+        self.preloaded = False
+
+    def get(self, name: str, size: tuple[int, int] | None = None, zoom: float | None = None,
+            angle: int = 0, flip: tuple[bool, bool] = (False, False)) -> pg.Surface:
+        """
+        加工済みの画像Surfaceを返す（未作成なら作成してキャッシュする）
+        引数1 name：fig/内のファイル名
+        引数2 size：scaleするサイズ
+        引数3 zoom：rotozoomの倍率
+        引数4 angle：rotozoomの角度（整数）
+        引数5 flip：(左右反転, 上下反転)
+        """
+        key = (name, size, zoom, angle, flip)
+        img = self.surfaces.get(key)
+        if img is not None:
+            return img
+        if self.preloaded:
+            self.misses += 1
+        if key == (name, None, None, 0, (False, False)):
+            img = self._load(name)
+        else:
+            img = self.get(name)
+            if size is not None:
+                img = pg.transform.scale(img, size)
+            if zoom is not None or angle:
+                img = pg.transform.rotozoom(img, angle, 1.0 if zoom is None else zoom)
+            if flip != (False, False):
+                img = pg.transform.flip(img, *flip)
+        self.surfaces[key] = img
+        return img
+
+    def laplacian(self, img: pg.Surface, colorkey: tuple[int, int, int] | None = None) -> pg.Surface:
+        """
+        imgにラプラシアンフィルタをかけたSurfaceを返す（同じimgに対しては一度だけ計算する）
+        引数1 img：元のSurface
+        引数2 colorkey：結果に設定する透明色
+        """
+        key = ("laplacian", img, colorkey)
+        filtered = self.surfaces.get(key)
+        if filtered is None:
+            filtered = pg.transform.laplacian(img)
+            if colorkey is not None:
+                filtered.set_colorkey(colorkey)
+            self.surfaces[key] = filtered
+        return filtered
+
+    def mask(self, img: pg.Surface) -> pg.mask.Mask:
+        """
+        imgの不透明な画素のMaskを返す（同じimgに対しては一度だけ作成し，そのimgを使うスプライトで共有する）
+        引数 img：画像キャッシュなどで共有しているSurface
+        """
+        mask = self.masks.get(img)
+        if mask is None:
+            mask = pg.mask.from_surface(img)
+            self.masks[img] = mask
+        return mask
+
+    def source(self, name: str) -> list[int] | None:
+        """
+        元の画像ファイルが変わったかを確かめるための[バイト数, 更新時刻[ns]]（ファイルがなければNone）
+        引数 name：fig/内のファイル名
+        """
+        try:
+            st = os.stat(f"{self.root}/{name}")
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def _load(self, name: str) -> pg.Surface:
+        """
+        画像を読み込む（アトラスにある画像はアトラスを一度だけ読み込み，そのsubsurfaceを返す）
+        """
+        sprite = self.sprites.get(name)
+        if sprite is None:
+            return self._decode(name)
+        page = self.pages.get(sprite["page"])
+        if page is None:
+            try:
+                page = self.pages[sprite["page"]] = self._decode(sprite["page"])
+            except (FileNotFoundError, pg.error):  # 起動後にアトラスが消えた・壊れたときは元のファイルを使う
+                self.sprites = {key: value for key, value in self.sprites.items()
+                                if value["page"] != sprite["page"]}
+                return self._decode(name)
+        img = page.subsurface(sprite["rect"])
+        if "colorkey" in sprite:  # 透明色はsubsurfaceごとに設定する
+            img.set_colorkey(sprite["colorkey"])
+        return img
+
+    def _decode(self, file: str) -> pg.Surface:
+        """
+        ディスクから画像ファイルを読み込み，画面があれば表示用フォーマットに変換する
+        load_async()でデコード中のファイルは，別に読み込まずにその完了を待つ
+        """
+        future = self.pending.pop(file, None)
+        img = future.result() if future is not None else pg.image.load(f"{self.root}/{file}")
+        self.load_count += 1
+        if pg.display.get_surface() is not None:
+            img = img.convert_alpha() if img.get_flags() & pg.SRCALPHA else img.convert()
+        return img
+
+    def _file(self, name: str) -> str:
+        """
+        画像nameを読み込むときにデコードするファイル名（アトラスにあればアトラスのファイル名）
+        """
+        sprite = self.sprites.get(name)
+        return name if sprite is None else sprite["page"]
+
+    def load_async(self, names: list[str], workers: int = 4):
+        """
+        画像ファイルのデコードをスレッドプールで始める（表示用フォーマットへの変換はget()のときにメインスレッドで行う）
+        引数1 names：fig/内のファイル名のリスト（先頭から順にデコードする，アトラスにある画像はアトラスをデコードする）
+        引数2 workers：デコードするスレッドの数
+        """
+        pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="images")
+        for file in dict.fromkeys(map(self._file, names)):
+            loaded = file in self.pages or (file, None, None, 0, (False, False)) in self.surfaces
+            if not loaded and file not in self.pending:
+                self.pending[file] = pool.submit(pg.image.load, f"{self.root}/{file}")
+                self.async_total += 1
+        pool.shutdown(wait=False)  # 投入済みのデコードは続ける
+
+    def ready(self, names) -> bool:
+        """
+        namesの画像をget()してもデコードを待たずに済むかどうか
+        """
+        pending = self.pending
+        return all(file not in pending or pending[file].done() for file in map(self._file, names))
+
+    def progress(self) -> float:
+        """
+        load_async()で始めたデコードのうち終わったものの割合（0～1）
+        """
+        if not self.async_total:
+            return 1.0
+        return 1 - sum(not future.done() for future in self.pending.values()) / self.async_total
+
+    def stats(self) -> dict:
+        """
+        読み込み回数，キャッシュ数，保持しているバイト数を返す（subsurfaceはアトラスの分として数える）
+        """
+        own = [img for img in self.surfaces.values() if img.get_parent() is None]
+        return {
+            "loads": self.load_count,
+            "surfaces": len(self.surfaces),
+            "atlases": len(self.pages),
+            "bytes": sum(img.get_pitch() * img.get_height() for img in [*own, *self.pages.values()]),
+            "misses": self.misses,
+            "masks": len(self.masks),
+        }
+
+
+images = ImageCache()  # ゲーム全体で共有する画像キャッシュ
+
+
+def collide_mask(a: pg.sprite.Sprite, b: pg.sprite.Sprite) -> bool:
+    """
+    pg.sprite.collide_maskと同じ判定を，画像キャッシュで共有しているMaskで行う
+    矩形が重なっている組だけに使う（spritecollideのcollided引数などに渡す）
+    """
+    return images.mask(a.image).overlap(images.mask(b.image), (b.rect.x - a.rect.x, b.rect.y - a.rect.y)) is not None
+
+
+class CachedText:
+    """
+    文字列が変わったときだけ描き直す文字列表示に関するクラス
+    glyphs=Trueのときは事前に描画した数字などのグリフをblitで並べて組み立てるので，
+    スコアのように頻繁に変わる数値でもフォントのレンダリングが走らない
+    """
+    fonts = {}  # サイズ -> Font（同じサイズのFontは共有する）
+
+    def __init__(self, size: int, color: tuple[int, int, int], antialias: bool = True, glyphs: bool = False):
+        """
+        引数1 size：フォントサイズ
+        引数2 color：文字色
+        引数3 antialias：アンチエイリアスの有無
+        引数4 glyphs：Trueならグリフを組み合わせて描画する
+        """
+        if size not in __class__.fonts:
+            __class__.fonts[size] = pg.font.Font(None, size)
+        self.font = __class__.fonts[size]
+        self.color = color
+        self.antialias = antialias
+        self.glyphs = None
+        if glyphs:
+            self.glyphs = {}
+            for ch in "0123456789":  # 数字のグリフは最初に描画しておく
+                self._glyph(ch)
+        self.text = None
+        self.image = None
+        self.renders = 0  # 実際に描き直した回数
+
+    def render(self, text: str) -> pg.Surface:
+        """
+        文字列のSurfaceを返す（前回と同じ文字列ならキャッシュを返す）
+        引数 text：表示する文字列
+        """
+        if text != self.text:
+            self.text = text
+            if self.glyphs is None:
+                self.image = self.font.render(text, self.antialias, self.color)
+            else:
+                self.image = self._compose(text)
+            self.renders += 1
+        return self.image
+
+    def _glyph(self, ch: str) -> pg.Surface:
+        """
+        1文字分のグリフを返す（初めての文字なら描画して保存する）
+        """
+        glyph = self.glyphs.get(ch)
+        if glyph is None:
+            glyph = self.font.render(ch, self.antialias, self.color)
+            if pg.display.get_surface() is not None:
+                glyph = glyph.convert_alpha()
+            self.glyphs[ch] = glyph
+        return glyph
+
+    def _compose(self, text: str) -> pg.Surface:
+        """
+        グリフを横に並べて文字列のSurfaceを組み立てる
+        """
+        glyphs = [self._glyph(ch) for ch in text]
+        image = pg.Surface((sum(g.get_width() for g in glyphs), self.font.get_height()), pg.SRCALPHA)
+        x = 0
+        seq = []
+        for glyph in glyphs:
+            seq.append((glyph, (x, 0), None, pg.BLEND_RGBA_MAX))  # 透明な下地にそのまま重ねる
+            x += glyph.get_width()
+        image.blits(seq, doreturn=False)
+        return image
+
+
+class Timer:
+    """
+    TimerWheelに登録した1つのタイマー
+    """
+    __slots__ = ("wheel", "tick", "callback", "args")
+
+    def __init__(self, wheel: "TimerWheel", tick: int, callback, args: tuple):
+        self.wheel = wheel
+        self.tick = tick  # 発火するフレーム
+        self.callback = callback  # Noneなら取り消し済み
+        self.args = args
+
+    def cancel(self):
+        """
+        タイマーを取り消す（ホイールからは発火・繰り下げのときに取り除かれる）
+        """
+        self.callback = None
+
+    def remaining(self) -> int:
+        """
+        戻り値：発火するまでに終わるフレーム数（このフレームの終わりに発火するなら0）
+        """
+        return self.tick - self.wheel.frame
+
+
+class TimerWheel:
+    """
+    階層型のタイミングホイール
+    1段目は1フレーム単位の64スロット，2段目は64フレーム単位の64スロット…と4段重ね，約2**24フレーム先までを扱う
+    上の段のスロットは下の段が一周するたびに1つだけ下の段へ繰り下げるので，
+    毎フレームの処理は発火するタイマーの数に比例し，登録されているタイマーの数にはよらない
+    """
+    bits = 6  # 1段のスロット数は2**bits
+    levels = 4
+
+    def __init__(self):
+        size = 1 << __class__.bits
+        self.wheels = [[[] for _ in range(size)] for _ in range(__class__.levels)]
+        self.frame = 0  # 現在のフレーム（advance()で終わらせると1進む）
+        self.fired = 0  # 直近のadvance()で発火したタイマーの数
+
+    def schedule(self, delay: int, callback, *args) -> Timer:
+        """
+        delayフレーム後のフレームの終わりにcallback(*args)を呼ぶタイマーを登録する
+        引数1 delay：0以上のフレーム数（0ならこのフレームの終わり）
+        引数2 callback：呼び出す関数
+        戻り値：取り消しに使うTimer
+        """
+        timer = Timer(self, self.frame + max(0, delay), callback, args)
+        self._add(timer)
+        return timer
+
+    def _add(self, timer: Timer):
+        """
+        残りフレーム数に応じた段のスロットにタイマーを入れる（範囲外の遠い先は最上段の最後のスロット）
+        """
+        bits, mask = __class__.bits, (1 << __class__.bits) - 1
+        tick = min(timer.tick, self.frame + (1 << bits * __class__.levels) - 1)
+        delta = tick - self.frame
+        level = 0
+        while delta >> bits * (level+1):
+            level += 1
+        self.wheels[level][tick >> bits * level & mask].append(timer)
+
+    def advance(self):
+        """
+        現在のフレームを終わらせ，このフレームに発火するタイマーを呼び出してから1フレーム進める
+        """
+        bits, mask = __class__.bits, (1 << __class__.bits) - 1
+        frame = self.frame
+        # 下の段が一周したら，上の段の次のスロットを繰り下げる（Linuxのタイマーホイールと同じ）
+        level = 0
+        while level + 1 < __class__.levels and frame >> bits * level & mask == 0:
+            level += 1
+            slot = self.wheels[level]
+            index = frame >> bits * level & mask
+            timers, slot[index] = slot[index], []
+            for timer in timers:
+                if timer.callback is not None:
+                    self._add(timer)
+        fired = 0
+        slot = self.wheels[0]
+        index = frame & mask
+        while slot[index]:  # 発火中に同じフレームへ登録されたタイマーも呼び出す
+            timers, slot[index] = slot[index], []
+            for timer in timers:
+                callback = timer.callback
+                if callback is not None:
+                    timer.callback = None
+                    callback(*timer.args)
+                    fired += 1
+        self.fired = fired
+        self.frame = frame + 1
+
+
+class SpritePool:
+    """
+    kill()されたスプライトを保管し，次の生成時に再利用するプール
+    """
+    pools = []  # 作成したすべてのプール
+
+    def __init__(self, cls: type):
+        """
+        引数 cls：プールするPooledSpriteのサブクラス
+        """
+        self.cls = cls
+        self.free = []  # 再利用を待つスプライト
+        self.hits = 0  # 再利用した回数
+        self.misses = 0  # 新しく生成した回数
+        __class__.pools.append(self)
+
+    def acquire(self, *args) -> "PooledSprite":
+        """
+        プールにあれば再利用し，なければ新しく生成したスプライトを返す
+        引数：clsのreset()に渡す引数
+        """
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(*args)
+            self.hits += 1
+        else:
+            sprite = self.cls(*args)
+            self.misses += 1
+        return sprite
+
+    def release(self, sprite: "PooledSprite"):
+        self.free.append(sprite)
+
+    @classmethod
+    def stats(cls) -> dict[str, dict[str, int]]:
+        """
+        プールごとの再利用回数，生成回数，保管数を返す
+        """
+        return {pool.cls.__name__: {"hits": pool.hits, "misses": pool.misses, "free": len(pool.free)}
+                for pool in cls.pools}
+
+
+class PooledSprite(pg.sprite.Sprite):
+    """
+    kill()されるとプールに戻り，acquire()で再利用されるスプライトの基底クラス
+    サブクラスは初期化の処理を__init__ではなくreset()に書く
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.pool = SpritePool(cls)
+
+    def __init__(self, *args):
+        super().__init__()
+        self.reset(*args)
+
+    def reset(self, *args):
+        raise NotImplementedError
+
+    @classmethod
+    def acquire(cls, *args) -> "PooledSprite":
+        """
+        プールから取り出したスプライトを返す（引数はreset()と同じ）
+        """
+        return cls.pool.acquire(*args)
+
+    def kill(self):
+        if self.alive():  # 二重にプールへ戻さない
+            super().kill()
+            self.pool.release(self)
+
+
 def gameover(screen: pg.Surface) -> None:
     """
-    ゲームオーバー画面を表示する関数。
+    ゲームオーバー画面を描画する関数（表示時間はResultSceneがフレーム数で数える）
     引数:screen 
     ゲームのメイン画面のSurface
     """
@@ -26,8 +464,7 @@ def gameover(screen: pg.Surface) -> None:
     text_rect = text.get_rect(center=(WIDTH // 2, HEIGHT // 2 - 50))  # 画面中央に表示
 
     # こうかとんの画像を読み込む
-    kk_cry_img = pg.image.load("fig/100.png")  # 悲しみこうかとん
-    kk_cry_img = pg.transform.rotozoom(kk_cry_img, 0, 0.3)
+    kk_cry_img = images.get("100.png", zoom=0.3)  # 悲しみこうかとん
     kk_left_rect = kk_cry_img.get_rect(center=(WIDTH // 2 , HEIGHT // 2 + 50))
 
     # 画面に描画
@@ -35,25 +472,77 @@ def gameover(screen: pg.Surface) -> None:
     screen.blit(text, text_rect)  # Game Overの文字を表示
     screen.blit(kk_cry_img, kk_left_rect)  # 丸焼きの画像
 
-    pg.display.update()
-    time.sleep(5)  # 5秒間表示
-
 
-class Gravity(pg.sprite.Sprite):
+class ScreenEffect(pg.sprite.Sprite):
     """
-    重力場に関するクラス
+    画面全体に半透明の色を重ねるエフェクト（重力場，EMP）の基底クラス
+    オーバーレイはエフェクトの種類ごとに1枚だけ作って共有し，濃さはアルファ値で変える
     """
-    def __init__(self, life: int):
+    color = (0, 0, 0)  # オーバーレイの色
+    alpha = 128  # オーバーレイの不透明度
+    fade = 1  # 消える前のこのフレーム数でフェードアウトする
+    overlays = {}  # エフェクトのクラス -> 画面サイズのオーバーレイ
+
+    def __init__(self, life: int, timers: TimerWheel):
+        """
+        引数1 life：表示するフレーム数（このフレームから数えてlifeフレーム後の終わりに消える）
+        引数2 timers：消滅を登録するTimerWheel
+        """
         super().__init__()
-        self.image = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
-        self.image.fill((0, 0, 0, 128))  # 透明度128の黒い矩形
-        self.rect = self.image.get_rect()
-        self.life = life
+        self.rect = pg.Rect(0, 0, WIDTH, HEIGHT)
+        self.timer = timers.schedule(life, self.kill)
 
-    def update(self):
-        self.life -= 1
-        if self.life < 0:
-            self.kill()
+    @property
+    def life(self) -> int:
+        """
+        残りの表示フレーム数
+        """
+        return self.timer.remaining()
+
+    @classmethod
+    def overlay(cls) -> pg.Surface:
+        """
+        このエフェクトのオーバーレイを返す（初回だけ作成する）
+        """
+        img = __class__.overlays.get(cls)
+        if img is None:
+            img = pg.Surface((WIDTH, HEIGHT))
+            img.fill(cls.color)
+            __class__.overlays[cls] = img
+        return img
+
+    def opacity(self) -> float:
+        """
+        残りの表示時間に応じた不透明度（0～255）を返す
+        """
+        return self.alpha * min(1.0, (self.life + 1) / self.fade)
+
+    @classmethod
+    def blits(cls, effects: pg.sprite.AbstractGroup) -> list[tuple[pg.Surface, tuple[int, int]]]:
+        """
+        重なっているエフェクトをひとつの不透明度にまとめ，共有のオーバーレイを1回だけ転送する
+        引数 effects：このクラスのエフェクトのグループ
+        戻り値：オーバーレイの(Surface, 位置)のリスト（エフェクトがなければ空）
+        """
+        if not effects:
+            return []
+        transparency = 1.0
+        for effect in effects:
+            transparency *= 1 - effect.opacity() / 255
+        alpha = round(255 * (1 - transparency))
+        if alpha <= 0:
+            return []
+        img = cls.overlay()
+        img.set_alpha(alpha if alpha < 255 else None)  # 完全に不透明なら合成せずに転送する（alpha=255の合成は遅い）
+        return [(img, (0, 0))]
+
+
+class Gravity(ScreenEffect):
+    """
+    重力場に関するクラス
+    """
+    color = (0, 0, 0)  # 透明度128の黒い矩形
+    fade = 50
 
 
 
@@ -81,15 +570,176 @@ def calc_orientation(org: pg.Rect, dst: pg.Rect) -> tuple[float, float]:
     norm = math.sqrt(x_diff**2+y_diff**2)
     return x_diff/norm, y_diff/norm
 
-def draw_charge_indicator(screen, is_charged):
+def draw_charge_indicator(screen, is_charged) -> pg.Rect:
     """
     チャージショットの状態を示す四角形を描画する
     引数:
         screen: 描画先の画面
         is_charged: チャージショットが完了しているかのフラグ（True/False）
+    戻り値：描画した領域
     """
     color = (0, 255, 0) if is_charged else (255, 0, 0)  # 緑: 完了, 赤: 未完了
-    pg.draw.rect(screen, color, (WIDTH - 80, HEIGHT - 80, 50, 50))  # 右下に四角形を描画
+    return pg.draw.rect(screen, color, (WIDTH - 80, HEIGHT - 80, 50, 50))  # 右下に四角形を描画
+
+
+class ScreenUpdater:
+    """
+    画面全体の更新と，変化した領域だけを転送するダーティレクト更新を切り替えるクラス
+    """
+    def __init__(self, dirty: bool = False):
+        """
+        引数 dirty：Trueなら変化した領域だけをpg.display.updateに渡す
+        """
+        self.dirty = dirty
+        self.rects = []  # このフレームで変化した領域
+        self.tracked = []  # このフレームで自前で描画した領域（次のフレームで消すためにも使う）
+        self.prev_tracked = []
+        self.area = 0  # 直近のフレームで転送した面積[px]
+
+    def add(self, rects: list[pg.Rect]):
+        """
+        RenderQueue.flushの戻り値のように，移動前の領域も含んだ矩形を登録する
+        """
+        self.rects.extend(rects)
+
+    def track(self, *rects: pg.Rect):
+        """
+        自前でblitした領域を登録する（次のフレームでも移動前の領域として転送される）
+        """
+        self.tracked.extend(rect.copy() for rect in rects)
+
+    def flush(self, full: bool = False):
+        """
+        画面を更新する
+        引数 full：Trueならダーティレクトモードでも画面全体を更新する（背景スクロール中など）
+        """
+        if not self.dirty or full:
+            pg.display.update()
+            self.area = WIDTH * HEIGHT
+        else:
+            screen_rect = pg.Rect(0, 0, WIDTH, HEIGHT)
+            rects = [rect.clip(screen_rect) for rect in self.rects + self.tracked + self.prev_tracked]
+            rects = [rect for rect in rects if rect.w and rect.h]
+            pg.display.update(rects)
+            self.area = sum(rect.w * rect.h for rect in rects)
+        self.prev_tracked = self.tracked
+        self.rects, self.tracked = [], []
+
+
+class RenderQueue:
+    """
+    1フレーム分の(Surface, 位置)を描画順ごとに集め，1回のscreen.blitsでまとめて転送するクラス
+    """
+    # 描画順（小さいほど奥に描く）
+    OBSTACLE, GRAVITY, BIRD, BEAM, ENEMY, BOMB, EXPLOSION, SHIELD, ITEM, JEWEL, EMP = range(11)
+
+    def __init__(self):
+        self.layers = collections.defaultdict(list)  # 描画順 -> [(Surface, 位置)]
+        self.count = 0  # 直近のフレームで転送したSurfaceの数
+        self.drawn = []  # 直近のフレームで転送した領域（ダーティレクトで消すために使う）
+
+    def add(self, z: int, image: pg.Surface, dest: pg.Rect | tuple[int, int]):
+        self.layers[z].append((image, dest))
+
+    def extend(self, z: int, blits):
+        """
+        引数1 z：描画順
+        引数2 blits：(Surface, 位置)の列
+        """
+        self.layers[z].extend(blits)
+
+    def add_group(self, z: int, group: pg.sprite.AbstractGroup):
+        """
+        グループ内のスプライトをimageとrectで登録する（group.drawの代わり）
+        """
+        self.layers[z].extend((sprite.image, sprite.rect) for sprite in group)
+
+    def interpolate(self, prev: dict[int, tuple[int, int]], alpha: float, jump: int = 64):
+        """
+        登録されたRectの位置を，前のtickの位置から今の位置までの割合alphaの位置に置き換える
+        引数1 prev：id(Rect) -> 前のtickの左上の座標（World.snapshotで記録したもの）
+        引数2 alpha：前のtickから今のtickまでの経過の割合（0～1）
+        引数3 jump：1tickでこれより大きく動いたRect（再利用されたRectなど）は補間しない[px]
+        """
+        for blits in self.layers.values():
+            for i, (image, dest) in enumerate(blits):
+                old = prev.get(id(dest))
+                if old is None:
+                    continue
+                dx, dy = dest.x - old[0], dest.y - old[1]
+                if (dx or dy) and abs(dx) <= jump and abs(dy) <= jump:
+                    blits[i] = (image, (old[0] + round(dx * alpha), old[1] + round(dy * alpha)))
+
+    def flush(self, screen: pg.Surface, dirty: bool = False) -> list[pg.Rect]:
+        """
+        登録された(Surface, 位置)を描画順にまとめて転送し，キューを空にする
+        引数1 screen：画面Surface
+        引数2 dirty：Trueなら転送した領域を求める（ダーティレクト用）
+        戻り値：移動前（前のフレーム）の領域も含んだ変化した領域のリスト
+        """
+        blits = [blit for z in sorted(self.layers) for blit in self.layers[z]]
+        self.layers.clear()
+        self.count = len(blits)
+        if not dirty:
+            screen.blits(blits, doreturn=False)
+            self.drawn = []
+            return []
+        drawn = screen.blits(blits)
+        rects, self.drawn = drawn + self.drawn, drawn
+        return rects
+
+
+class Hud:
+    """
+    HUDの各表示をひとつの透明Surfaceにまとめ，状態が変わった表示だけを描き直すクラス
+    """
+    def __init__(self):
+        self.image = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+        self.widgets = {}  # 名前 -> {"state", "draw", "rect"}（登録順に描画する）
+        self.invalid = set()  # 描き直しが必要な表示の名前
+        self.rebuilds = 0  # HUDを描き直したフレーム数
+        self.reuses = 0  # キャッシュをそのまま使ったフレーム数
+
+    def update(self, name: str, state, draw):
+        """
+        表示の状態を登録し，前回と違っていれば描き直し対象にする
+        引数1 name：表示の名前
+        引数2 state：表示内容を決める値（比較可能なもの）
+        引数3 draw：Surfaceを受け取って描画し，描画した領域を返す関数
+        """
+        widget = self.widgets.get(name)
+        if widget is None:
+            widget = self.widgets[name] = {"state": None, "draw": draw, "rect": None}
+        elif widget["state"] == state:
+            return
+        widget["state"], widget["draw"] = state, draw
+        self.invalid.add(name)
+
+    def draw(self, screen: pg.Surface) -> list[pg.Rect]:
+        """
+        必要な表示だけHUDのSurfaceに描き直してから，HUDを画面に転送する
+        引数 screen：画面Surface
+        戻り値：転送した領域のリスト
+        """
+        if self.invalid:
+            # 消す領域に重なっている表示も描き直す
+            cleared = [self.widgets[name]["rect"] for name in self.invalid if self.widgets[name]["rect"]]
+            for name, widget in self.widgets.items():
+                if widget["rect"] and widget["rect"].collidelist(cleared) != -1:
+                    self.invalid.add(name)
+            for name in self.invalid:
+                if self.widgets[name]["rect"]:
+                    self.image.fill((0, 0, 0, 0), self.widgets[name]["rect"])
+            for name, widget in self.widgets.items():
+                if name in self.invalid:
+                    widget["rect"] = widget["draw"](self.image)
+            self.invalid.clear()
+            self.rebuilds += 1
+        else:
+            self.reuses += 1
+        rects = [widget["rect"] for widget in self.widgets.values()]
+        screen.blits([(self.image, rect, rect) for rect in rects], doreturn=False)
+        return rects
 
 
 class ChargeBar:
@@ -103,12 +753,11 @@ class ChargeBar:
         self.bar_height = 20  # チャージバーの高さ
         self.bar_pos = (WIDTH - 350, HEIGHT - 50)  # バーの位置
 
-    def update(self, charging: bool, screen: pg.Surface):
+    def update(self, charging: bool):
         """
-        チャージ時間の管理と描画
+        チャージ時間の管理
         引数:
             charging: チャージ中かどうかのフラグ（True/False）
-            screen: 描画先の画面
         """
         if charging:
             self.charge_time += 1
@@ -117,27 +766,41 @@ class ChargeBar:
         else:
             self.charge_time = 0  # チャージ解除でリセット
 
-        # チャージバーの描画
+    def draw(self, screen: pg.Surface) -> pg.Rect:
+        """
+        チャージバーの描画
+        引数 screen：描画先のSurface
+        戻り値：描画した領域
+        """
         filled_width = (self.charge_time / self.max_charge) * self.bar_width
-        pg.draw.rect(screen, (100, 100, 100), (*self.bar_pos, self.bar_width, self.bar_height))
+        rect = pg.draw.rect(screen, (100, 100, 100), (*self.bar_pos, self.bar_width, self.bar_height))
         pg.draw.rect(screen, (255, 0, 0), (*self.bar_pos, filled_width, self.bar_height))
+        return rect
 
 
 class Bird(pg.sprite.Sprite):
     """
     ゲームキャラクター（こうかとん）に関するクラス
     """
+    hyper_frames = 3  # 無敵モードのアニメーション枚数
+
     def __init__(self, num: int, xy: tuple[int, int]):
         super().__init__()
-        img0 = pg.transform.rotozoom(pg.image.load(f"fig/{num}.png"), 0, 0.9)
-        img = pg.transform.flip(img0, True, False)  # デフォルトのこうかとん
-        self.image = img
+        # 通常・無敵・悲しみの画像を生成時に作っておき，毎フレームは参照を切り替えるだけにする
+        self.normal_img = images.get(f"{num}.png", zoom=0.9, flip=(True, False))  # デフォルトのこうかとん
+        self.hyper_imgs = [images.laplacian(self.normal_img)]
+        for _ in range(__class__.hyper_frames-1):
+            self.hyper_imgs.append(images.laplacian(self.hyper_imgs[-1]))
+        self.dead_img = images.get("8.png", zoom=1.7)  # HPが0になった時の画像
+        self.image = self.normal_img
         self.rect = self.image.get_rect()
         self.rect.center = xy
         self.speed = 5
         self.state = "normal"
-        self.hyper_life = 500
+        self.hyper_life = 500  # 無敵モードのアニメーションの残りカウント
+        self.hyper_timer = None  # 無敵モードの終わりのタイマー
         self.hp = Health()
+        self.dire = (+1, 0)  # 一度も動かずに防御壁を出した場合も右向きとする
 
     def take_damage(self, damage):
         """
@@ -146,16 +809,34 @@ class Bird(pg.sprite.Sprite):
         if self.state != "hyper":
             self.hp.take_damage(damage)
 
-    def change_img(self, num: int, screen: pg.Surface):
+    def hyper(self, life: int, timers: TimerWheel):
+        """
+        無敵モードにする（無敵モード中なら残り時間を延ばす）
+        引数1 life：無敵モードの長さ（Bird.updateの回数．World.stepでは1フレームに2回呼ばれる）
+        引数2 timers：無敵モードの終わりを登録するTimerWheel
+        """
+        self.state = "hyper"
+        self.hyper_life = life
+        if self.hyper_timer is not None:
+            self.hyper_timer.cancel()
+        # 1フレームに2回数えるので，(life-1)//2フレーム後の終わりにはカウントが尽きている
+        self.hyper_timer = timers.schedule((life-1)//2, self.end_hyper)
+
+    def end_hyper(self):
+        """
+        無敵モードを終わらせる
+        """
+        self.state = "normal"
+        self.hyper_timer = None
+
+    def change_img(self, num: int):
         """
-        こうかとん画像を切り替え，画面に転送する
-        引数1 num：こうかとん画像ファイル名の番号
-        引数2 screen：画面Surface
+        こうかとん画像を切り替える
+        引数 num：こうかとん画像ファイル名の番号
         """
-        self.image = pg.transform.rotozoom(pg.image.load(f"fig/8.png"), 0, 1.7) #  HPが0になった時の画像
-        screen.blit(self.image, self.rect)
+        self.image = self.dead_img
 
-    def update(self, key_lst: list[bool], screen: pg.Surface):
+    def update(self, key_lst: list[bool]):
         sum_mv = [0, 0]
         for k, mv in {
             pg.K_UP: (0, -1),
@@ -171,194 +852,551 @@ class Bird(pg.sprite.Sprite):
             self.rect.move_ip(-self.speed*sum_mv[0], -self.speed*sum_mv[1])
         if not (sum_mv[0] == 0 and sum_mv[1] == 0):
             self.dire = tuple(sum_mv)
-        if self.state == "hyper":
-            self.image = pg.transform.laplacian(self.image)
+        if self.state == "hyper":  # 無敵モードの終わりはTimerWheelが知らせる
+            self.image = self.hyper_imgs[self.hyper_life//10%len(self.hyper_imgs)]
+            self.hyper_life -= 1
         else:
-            img0 = pg.transform.rotozoom(pg.image.load(f"fig/3.png"), 0, 0.9)
-            img = pg.transform.flip(img0, True, False)  # デフォルトのこうかとん
-            self.image = img
-        screen.blit(self.image, self.rect)
+            self.image = self.normal_img
 
-        if self.state == "hyper":
-            self.hyper_life -= 1
-            if self.hyper_life < 0:
-                self.state = "normal"
+    def blits(self) -> list[tuple[pg.Surface, pg.Rect]]:
+        """
+        戻り値：こうかとんの(Surface, 位置)のリスト
+        """
+        return [(self.image, self.rect)]
 
-class Bomb(pg.sprite.Sprite):
+class Bomb(PooledSprite):
     """
     爆弾に関するクラス
     """
     colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
+    radii = range(10, 51)  # 爆弾円の半径：10以上50以下
+    imgs = {}  # (半径, 色) -> 爆弾円Surface
 
-    def __init__(self, emy: "Enemy", bird: Bird):
+    @classmethod
+    def render(cls, rad: int, color: tuple[int, int, int]) -> pg.Surface:
         """
-        爆弾円Surfaceを生成する
+        爆弾円Surfaceを返す（半径と色の組ごとに一度だけ描画する）
+        """
+        img = cls.imgs.get((rad, color))
+        if img is None:
+            img = pg.Surface((2*rad, 2*rad))
+            pg.draw.circle(img, color, (rad, rad), rad)
+            img.set_colorkey((0, 0, 0), pg.RLEACCEL)  # 透明部分を飛ばして高速に転送する
+            cls.imgs[(rad, color)] = img
+        return img
+
+    def reset(self, emy: "Enemy", bird: Bird, rng=random, speed: float = 6):
+        """
+        爆弾を初期化する
         引数1 emy：爆弾を投下する敵機
         引数2 bird：攻撃対象のこうかとん
+        引数3 rng：乱数生成器
+        引数4 speed：爆弾の速さ
         """
-        super().__init__()
-        rad = random.randint(10, 50)  # 爆弾円の半径：10以上50以下の乱数
-        self.image = pg.Surface((2*rad, 2*rad))
-        color = random.choice(__class__.colors)  # 爆弾円の色：クラス変数からランダム選択
-        pg.draw.circle(self.image, color, (rad, rad), rad)
-        self.image.set_colorkey((0, 0, 0))
+        rad = rng.randint(10, 50)  # 爆弾円の半径：10以上50以下の乱数
+        color = rng.choice(__class__.colors)  # 爆弾円の色：クラス変数からランダム選択
+        self.image = __class__.render(rad, color)
         self.rect = self.image.get_rect()
         # 爆弾を投下するemyから見た攻撃対象のbirdの方向を計算
         self.vx, self.vy = calc_orientation(emy.rect, bird.rect)  
         self.rect.centerx = emy.rect.centerx
         self.rect.centery = emy.rect.centery+emy.rect.height//2
-        self.speed = 6
+        self.x, self.y = float(self.rect.x), float(self.rect.y)  # 小数の位置（Rectは描画と衝突判定用に丸めた位置）
+        self.speed = speed
         self.state = "aaa"
 
     def update(self):
         """
         爆弾を速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        位置は小数のまま進め，Rectには四捨五入（偶数丸め）した位置を入れるので，遅い爆弾や斜めの爆弾も向きがずれない
         """
-        self.rect.move_ip(self.speed*self.vx, self.speed*self.vy)
+        self.x += self.speed*self.vx
+        self.y += self.speed*self.vy
+        self.rect.topleft = round(self.x), round(self.y)
         if check_bound(self.rect) != (True, True):
             self.kill()
 
-class Beam(pg.sprite.Sprite):
+class BombSprites:
     """
-    通常の弾とチャージショットに関するクラス
+    爆弾をBombスプライトのグループで管理するクラス（NumPyがないときに使う）
+    BombArrayと同じメソッドを持ち，同じ入力なら同じ結果になる
     """
-    def __init__(self, bird: "Bird", max_charged: bool):
-        super().__init__()
-        self.beams = []  # 複数のビームを格納するリスト
-        if max_charged:  # MAXチャージ時は5本のビームを生成
-            for i in range(-2, 3):  # 5本のビームを上下に1pxずつずらす
-                self.img = pg.transform.scale(pg.image.load("fig/BEEM1.png"), (300, 75))
-                self.rect = self.img.get_rect()
-                self.rect.centery = bird.rect.centery + i * 0.01 #ここいじったらビームの重なり方が代わるよ
-                self.rect.left = bird.rect.right
-                self.beams.append({"img": self.img, "rct": self.rect, "vx": 20})
-        else:  # 通常弾
-            self.img = pg.image.load("fig/beam.png")
-            self.rect = self.img.get_rect()
-            self.rect.centery = bird.rect.centery
-            self.rect.left = bird.rect.right
-            self.beams.append({"img": self.img, "rct": self.rect, "vx": 10})
+    def __init__(self, broadphase: type["Broadphase"]):
+        """
+        引数 broadphase：衝突判定のブロードフェーズ
+        """
+        self.group = pg.sprite.Group()
+        self.broadphase = broadphase
 
-    def update(self, screen: pg.Surface):
+    def __len__(self) -> int:
+        return len(self.group)
+
+    def spawn(self, emy: "Enemy", bird: Bird, rng=random, speed: float = 6):
         """
-        ビームの移動と描画
+        emyからbirdに向けて爆弾を投下する
+        引数1 emy：爆弾を投下する敵機
+        引数2 bird：攻撃対象のこうかとん
+        引数3 rng：乱数生成器
+        引数4 speed：爆弾の速さ
         """
-        for beam in self.beams:
-            if check_bound(beam["rct"]) == (True, True):
-                beam["rct"].move_ip(beam["vx"], 0)
-                screen.blit(beam["img"], beam["rct"])
-        
-        if check_bound(self.rect) != (True, True):
-            self.kill()
+        self.group.add(Bomb.acquire(emy, bird, rng, speed))
 
-class Explosion(pg.sprite.Sprite):
-    """
-    爆発に関するクラス
-    """
-    def __init__(self, obj: "Bomb|Enemy", life: int):
+    def disable(self):
         """
-        爆弾が爆発するエフェクトを生成する
-        引数1 obj：爆発するBombまたは敵機インスタンス
-        引数2 life：爆発時間
+        EMPですべての爆弾を無効化し，速度を半減する
         """
-        super().__init__()
-        img = pg.image.load(f"fig/explosion.gif")
-        self.imgs = [img, pg.transform.flip(img, 1, 1)]
-        self.image = self.imgs[0]
-        self.rect = self.image.get_rect(center=obj.rect.center)
-        self.life = life
+        for bomb in self.group:
+            bomb.speed /= 2  # 爆弾の速度を半減する
+            bomb.state = "inactive"
 
-    def update(self):
+    def rects(self) -> list[pg.Rect]:
+        return [bomb.rect for bomb in self.group]
+
+    def collide(self, rects: list[pg.Rect]) -> list[tuple[pg.Rect, bool]]:
         """
-        爆発時間を1減算した爆発経過時間_lifeに応じて爆発画像を切り替えることで
-        爆発エフェクトを表現する
+        rectsのどれかと重なる爆弾を消す
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
         """
-        self.life -= 1
-        self.image = self.imgs[self.life//10%2]
-        if self.life < 0:
-            self.kill()
+        if len(rects) == 1:
+            hits = self.broadphase(self.group).query(rects[0])
+        else:
+            hits = [bomb for bomb in self.group.sprites() if bomb.rect.collidelist(rects) != -1]
+        for bomb in hits:
+            bomb.kill()
+        return [(bomb.rect, bomb.state != "inactive") for bomb in hits]
 
-class get_efect(pg.sprite.Sprite):
-    """
-    キラキラエフェクトに関するクラス
-    """
-    def __init__(self, obj, life: int):
+    def clear(self) -> list[tuple[pg.Rect, bool]]:
         """
-        キラキラエフェクトを生成する
-        引数1 obj：itemインスタンス
-        引数2 life：エフェクト発生時間
+        すべての爆弾を消す（プールに戻すため1つずつkillする）
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
         """
-        super().__init__()
-        img = pg.image.load(f"fig/kirakira.png")
-        self.imgs = [img, pg.transform.flip(img, 1, 1)]
-        self.image = self.imgs[0]
-        self.rect = self.image.get_rect(center=obj.rct.center)
-        self.life = life
+        hits = self.group.sprites()
+        for bomb in hits:
+            bomb.kill()
+        return [(bomb.rect, bomb.state != "inactive") for bomb in hits]
+
+    def collide_mask(self, sprite: pg.sprite.Sprite) -> list[tuple[pg.Rect, bool]]:
+        """
+        spriteと矩形が重なる爆弾のうち，不透明な画素も重なる爆弾だけを消す
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
+        """
+        hits = self.broadphase(self.group).spritecollide(sprite, True, collide_mask)
+        return [(bomb.rect, bomb.state != "inactive") for bomb in hits]
+
+    def collide_beams(self, beams: pg.sprite.AbstractGroup) -> list[tuple[pg.Rect, bool]]:
+        """
+        ビームと重なる爆弾を消し，当たったビームも消す（pg.sprite.groupcollide(bombs, beams, True, True)と同じ）
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
+        """
+        hits = self.broadphase(beams).groupcollide(self.group, True, True)
+        return [(bomb.rect, bomb.state != "inactive") for bomb in hits]
 
     def update(self):
+        self.group.update()
+
+    def snapshot(self):
         """
-        エフェクト時間を1減算したエフェクト経過時間_lifeに応じてエフェクト画像を切り替えることで
-        エフェクトを表現する
+        爆弾のRectはWorld.snapshotで他のスプライトと一緒に記録する
         """
-        self.life -= 1
-        self.image = self.imgs[self.life//10%2]
-        if self.life < 0:
-            self.kill()
 
-class Enemy(pg.sprite.Sprite):
+    def blits(self, alpha: float = 1.0) -> list[tuple[pg.Surface, pg.Rect]]:
+        """
+        引数 alpha：補間はRenderQueue.interpolateで行うので使わない（BombArrayと同じ呼び出し方にするため）
+        """
+        return [(bomb.image, bomb.rect) for bomb in self.group]
+
+
+class BombArray:
     """
-    敵機に関するクラス
+    すべての爆弾の位置・速度・大きさ・状態をNumPy配列で持ち，移動・画面外判定・衝突判定をまとめて行うクラス
+    Bombスプライトと同じく位置は小数で進め，描画と衝突判定には偶数丸めした整数の位置を使うので，BombSpritesと同じ結果になる
     """
-    imgs = [pg.image.load(f"fig/alien{i}.png") for i in range(1, 4)]
-    
-    def __init__(self):
-        super().__init__()
-        self.image = random.choice(__class__.imgs)
-        self.rect = self.image.get_rect()
-        self.rect.center = WIDTH+50, random.randint(0, HEIGHT)  # 初期位置を右端に設定
-        self.vx, self.vy = -6, 0  # 左方向に移動
-        self.bound = random.randint(WIDTH // 2, WIDTH - 50)  # 停止位置
-        self.state = "left"  # 左移動状態or停止状態
-        self.interval = random.randint(50, 300)  # 爆弾投下インターバル
+    fields = {  # 配列名 -> 要素の型
+        "fx": "float64",  # 小数の左端
+        "fy": "float64",  # 小数の上端
+        "x": "int64",  # 丸めた左端（描画と衝突判定用）
+        "y": "int64",  # 丸めた上端
+        "px": "int64",  # 前のtickの左端（描画の補間用）
+        "py": "int64",  # 前のtickの上端
+        "size": "int64",  # 直径
+        "vx": "float64",
+        "vy": "float64",
+        "speed": "float64",
+        "active": "bool",  # EMPで無効化されたらFalse
+        "img": "intp",  # imgsの添字
+    }
+    chunk = 1 << 20  # ビームとの総当たり判定で一度に作る真理値配列の要素数
 
-    def update(self):
+    def __init__(self, capacity: int = 256):
         """
-        敵機を速度ベクトルself.vx, self.vyに基づき移動（左移動）させる
-        ランダムに決めた停止位置_boundまで移動したら，_stateを停止状態に変更する
-        引数 screen：画面Surface
+        引数 capacity：最初に確保する爆弾の数（足りなくなったら倍にする）
         """
-        if self.rect.centerx < self.bound:
+        self.n = 0  # 画面内の爆弾の数（各配列の先頭n個が有効）
+        for name, dtype in __class__.fields.items():
+            setattr(self, name, np.zeros(capacity, dtype))
+        self.imgs = [Bomb.render(rad, color) for rad in Bomb.radii for color in Bomb.colors]
+
+    def __len__(self) -> int:
+        return self.n
+
+    def spawn(self, emy: "Enemy", bird: Bird, rng=random, speed: float = 6):
+        """
+        emyからbirdに向けて爆弾を投下する（Bombと同じ順番で乱数を使う）
+        引数1 emy：爆弾を投下する敵機
+        引数2 bird：攻撃対象のこうかとん
+        引数3 rng：乱数生成器
+        引数4 speed：爆弾の速さ
+        """
+        rad = rng.randint(10, 50)  # 爆弾円の半径：10以上50以下の乱数
+        color = rng.choice(Bomb.colors)  # 爆弾円の色
+        if self.n == len(self.x):
+            for name in __class__.fields:
+                arr = getattr(self, name)
+                setattr(self, name, np.concatenate([arr, np.zeros_like(arr)]))
+        i = self.n
+        self.vx[i], self.vy[i] = calc_orientation(emy.rect, bird.rect)
+        self.x[i] = emy.rect.centerx - rad
+        self.y[i] = emy.rect.centery + emy.rect.height//2 - rad
+        self.fx[i], self.fy[i] = self.x[i], self.y[i]
+        self.px[i], self.py[i] = self.x[i], self.y[i]
+        self.size[i] = 2 * rad
+        self.speed[i] = speed
+        self.active[i] = True
+        self.img[i] = (rad - Bomb.radii[0]) * len(Bomb.colors) + Bomb.colors.index(color)
+        self.n += 1
+
+    def disable(self):
+        """
+        EMPですべての爆弾を無効化し，速度を半減する
+        """
+        self.speed[:self.n] /= 2
+        self.active[:self.n] = False
+
+    def rects(self) -> list[pg.Rect]:
+        n = self.n
+        return [pg.Rect(x, y, size, size)
+                for x, y, size in zip(self.x[:n].tolist(), self.y[:n].tolist(), self.size[:n].tolist())]
+
+    def _keep(self, mask: "np.ndarray"):
+        """
+        maskがTrueの爆弾だけを順番を保って残す
+        """
+        n, k = self.n, int(np.count_nonzero(mask))
+        if k == n:
+            return
+        for name in __class__.fields:
+            arr = getattr(self, name)
+            arr[:k] = arr[:n][mask]
+        self.n = k
+
+    def _remove(self, mask: "np.ndarray") -> list[tuple[pg.Rect, bool]]:
+        """
+        maskがTrueの爆弾を消し，(Rect, 有効かどうか)のリストを返す
+        """
+        n = self.n
+        hits = [(pg.Rect(x, y, size, size), active) for x, y, size, active in
+                zip(self.x[:n][mask].tolist(), self.y[:n][mask].tolist(),
+                    self.size[:n][mask].tolist(), self.active[:n][mask].tolist())]
+        self._keep(~mask)
+        return hits
+
+    def collide(self, rects: list[pg.Rect]) -> list[tuple[pg.Rect, bool]]:
+        """
+        rectsのどれかと重なる爆弾を消す
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
+        """
+        n = self.n
+        x, y, size = self.x[:n], self.y[:n], self.size[:n]
+        mask = np.zeros(n, bool)
+        for rect in rects:
+            if rect.w and rect.h:  # pg.Rect.colliderectと同じく大きさ0の矩形は重ならない
+                mask |= (x < rect.right) & (rect.left < x+size) & (y < rect.bottom) & (rect.top < y+size)
+        return self._remove(mask)
+
+    def clear(self) -> list[tuple[pg.Rect, bool]]:
+        """
+        すべての爆弾を消す（配列はそのまま使い回し，有効な数を0にする）
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
+        """
+        n = self.n
+        hits = [(pg.Rect(x, y, size, size), active) for x, y, size, active in
+                zip(self.x[:n].tolist(), self.y[:n].tolist(), self.size[:n].tolist(), self.active[:n].tolist())]
+        self.n = 0
+        return hits
+
+    def collide_mask(self, sprite: pg.sprite.Sprite) -> list[tuple[pg.Rect, bool]]:
+        """
+        spriteと矩形が重なる爆弾のうち，不透明な画素も重なる爆弾だけを消す
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
+        """
+        n, rect = self.n, sprite.rect
+        x, y, size = self.x[:n], self.y[:n], self.size[:n]
+        mask = (x < rect.right) & (rect.left < x+size) & (y < rect.bottom) & (rect.top < y+size)
+        sprite_mask = images.mask(sprite.image)
+        for i in np.flatnonzero(mask).tolist():  # 矩形が重なった爆弾だけ画素を比べる
+            bomb_mask = images.mask(self.imgs[self.img[i]])
+            mask[i] = sprite_mask.overlap(bomb_mask, (int(x[i]) - rect.x, int(y[i]) - rect.y)) is not None
+        return self._remove(mask)
+
+    def collide_beams(self, beams: pg.sprite.AbstractGroup) -> list[tuple[pg.Rect, bool]]:
+        """
+        ビームと重なる爆弾を消し，当たったビームも消す（pg.sprite.groupcollide(bombs, beams, True, True)と同じ）
+        groupcollideは爆弾を順に調べてビームを消していくので，各ビームは最初に重なった爆弾だけを消す
+        戻り値：消した爆弾の(Rect, 有効かどうか)のリスト（投下順）
+        """
+        n = self.n
+        sprites = [beam for beam in beams.sprites() if beam.rect.w and beam.rect.h]
+        if not n or not sprites:
+            return []
+        x, y = self.x[:n], self.y[:n]
+        right, bottom = x + self.size[:n], y + self.size[:n]
+        rects = np.array([tuple(beam.rect) for beam in sprites], np.int64)
+        left, top = rects[:, :1], rects[:, 1:2]
+        beam_right, beam_bottom = left + rects[:, 2:3], top + rects[:, 3:4]
+        first = np.full(len(sprites), -1)  # ビームごとに最初に重なった爆弾の添字
+        step = max(1, __class__.chunk // n)
+        for i in range(0, len(sprites), step):
+            j = slice(i, i+step)
+            hit = (x < beam_right[j]) & (left[j] < right) & (y < beam_bottom[j]) & (top[j] < bottom)
+            first[j] = np.where(hit.any(axis=1), hit.argmax(axis=1), -1)
+        for beam, index in zip(sprites, first.tolist()):
+            if index >= 0:
+                beam.kill()
+        mask = np.zeros(n, bool)
+        mask[first[first >= 0]] = True
+        return self._remove(mask)
+
+    def update(self):
+        """
+        爆弾を速度ベクトルに基づき移動させ，画面外に出た爆弾を消す
+        """
+        n = self.n
+        x, y, size, speed = self.x[:n], self.y[:n], self.size[:n], self.speed[:n]
+        fx, fy = self.fx[:n], self.fy[:n]
+        fx += speed * self.vx[:n]
+        fy += speed * self.vy[:n]
+        np.rint(fx, out=x, casting="unsafe")  # roundと同じく偶数丸めする
+        np.rint(fy, out=y, casting="unsafe")
+        self._keep((0 <= x) & (x+size <= WIDTH) & (0 <= y) & (y+size <= HEIGHT))
+
+    def snapshot(self):
+        """
+        描画の補間のために今の位置を覚えておく
+        """
+        n = self.n
+        self.px[:n] = self.x[:n]
+        self.py[:n] = self.y[:n]
+
+    def blits(self, alpha: float = 1.0):
+        """
+        引数 alpha：snapshot()の位置から今の位置までの割合（1なら今の位置）
+        戻り値：すべての爆弾の(Surface, 左上の座標)の列
+        """
+        n, imgs = self.n, self.imgs
+        x, y = self.x[:n], self.y[:n]
+        if alpha < 1:
+            px, py = self.px[:n], self.py[:n]
+            x = px + np.rint((x - px) * alpha).astype(np.int64)
+            y = py + np.rint((y - py) * alpha).astype(np.int64)
+        return zip(map(imgs.__getitem__, self.img[:n].tolist()), zip(x.tolist(), y.tolist()))
+
+
+BOMB_ENGINES = {"array": BombArray, "sprite": BombSprites}  # 爆弾の管理方式
+
+
+class Beam(PooledSprite):
+    """
+    通常の弾とチャージショットに関するクラス
+    """
+    def reset(self, bird: "Bird", max_charged: bool):
+        """
+        ビームを初期化する（再利用時は前回のビームの辞書とRectを使い回す）
+        引数1 bird：ビームを放つこうかとん
+        引数2 max_charged：MAXチャージかどうか
+        """
+        if not hasattr(self, "beams"):
+            self.beams = []  # 複数のビームを格納するリスト
+        if max_charged:  # MAXチャージ時は5本のビームを生成
+            self.img, offsets, vx = images.get("BEEM1.png", size=(300, 75)), range(-2, 3), 20  # 5本のビームを上下に1pxずつずらす
+        else:  # 通常弾
+            self.img, offsets, vx = images.get("beam.png"), [0], 10
+        while len(self.beams) < len(offsets):
+            self.beams.append({"img": None, "rct": pg.Rect(0, 0, 0, 0), "vx": 0})
+        del self.beams[len(offsets):]
+        for i, beam in zip(offsets, self.beams):
+            self.rect = beam["rct"]
+            self.rect.size = self.img.get_size()
+            self.rect.centery = bird.rect.centery + i * 0.01 #ここいじったらビームの重なり方が代わるよ
+            self.rect.left = bird.rect.right
+            beam["img"], beam["vx"] = self.img, vx
+
+    def update(self):
+        """
+        ビームの移動
+        """
+        for beam in self.beams:
+            if check_bound(beam["rct"]) == (True, True):
+                beam["rct"].move_ip(beam["vx"], 0)
+        
+        if check_bound(self.rect) != (True, True):
+            self.kill()
+
+    def blits(self) -> list[tuple[pg.Surface, pg.Rect]]:
+        """
+        戻り値：画面内のビームの(Surface, 位置)のリスト
+        """
+        return [(beam["img"], beam["rct"]) for beam in self.beams if check_bound(beam["rct"]) == (True, True)]
+
+class TimedEffect(PooledSprite):
+    """
+    2枚の画像を10フレームごとに切り替え，寿命が来たら消えるエフェクトの基底クラス
+    画像の切り替えと消滅はTimerWheelに登録するので，毎フレームのupdate()はない
+    """
+    def start(self, imgs: list[pg.Surface], center: tuple[int, int], life: int, timers: TimerWheel):
+        """
+        引数1 imgs：切り替える2枚の画像
+        引数2 center：表示する位置
+        引数3 life：表示するフレーム数（このフレームから数えてlifeフレーム後の終わりに消える）
+        引数4 timers：切り替えと消滅を登録するTimerWheel
+        """
+        self.imgs = imgs
+        self.image = imgs[0]
+        self.rect = self.image.get_rect(center=center)
+        self.life = life
+        self.born = timers.frame
+        self.expire_timer = timers.schedule(life, self.kill)
+        self.flip_timer = timers.schedule(0, self.flip)
+
+    def flip(self):
+        """
+        残り時間(life-経過フレーム数)の10の位に応じて画像を切り替え，次に変わるフレームのタイマーを登録する
+        """
+        timers = self.expire_timer.wheel
+        rest = self.life - (timers.frame - self.born + 1)
+        self.image = self.imgs[rest//10%2]
+        self.flip_timer = timers.schedule(rest%10 + 1, self.flip)
+
+    def kill(self):
+        self.expire_timer.cancel()
+        self.flip_timer.cancel()
+        super().kill()
+
+
+class Explosion(TimedEffect):
+    """
+    爆発に関するクラス
+    """
+    def reset(self, obj: "Bomb|Enemy", life: int, timers: TimerWheel):
+        """
+        爆弾が爆発するエフェクトを生成する
+        引数1 obj：爆発するBombまたは敵機インスタンス（爆発する位置のRectでもよい）
+        引数2 life：爆発時間
+        引数3 timers：画像の切り替えと消滅を登録するTimerWheel
+        """
+        imgs = [images.get("explosion.gif"), images.get("explosion.gif", flip=(True, True))]
+        self.start(imgs, getattr(obj, "rect", obj).center, life, timers)
+
+
+class get_efect(TimedEffect):
+    """
+    キラキラエフェクトに関するクラス
+    """
+    def reset(self, obj, life: int, timers: TimerWheel):
+        """
+        キラキラエフェクトを生成する
+        引数1 obj：itemインスタンス
+        引数2 life：エフェクト発生時間
+        引数3 timers：画像の切り替えと消滅を登録するTimerWheel
+        """
+        imgs = [images.get("kirakira.png"), images.get("kirakira.png", flip=(True, True))]
+        self.start(imgs, obj.rct.center, life, timers)
+
+
+class Enemy(pg.sprite.Sprite):
+    """
+    敵機に関するクラス
+    """
+    imgs = [f"alien{i}.png" for i in range(1, 4)]
+    serials = itertools.count()  # 生成順の通し番号（爆弾を投下する順番に使う）
+    
+    def __init__(self, rng=random, interval: tuple[int, int] = (50, 300)):
+        """
+        引数1 rng：乱数生成器
+        引数2 interval：爆弾投下インターバルの範囲
+        """
+        super().__init__()
+        self.image = images.get(rng.choice(__class__.imgs))
+        self.rect = self.image.get_rect()
+        self.rect.center = WIDTH+50, rng.randint(0, HEIGHT)  # 初期位置を右端に設定
+        self.vx, self.vy = -6, 0  # 左方向に移動
+        self.bound = rng.randint(WIDTH // 2, WIDTH - 50)  # 停止位置
+        self.state = "left"  # 左移動状態or停止状態
+        self.interval = rng.randint(*interval)  # 爆弾投下インターバル
+        self.serial = next(__class__.serials)
+        self.armed = True  # FalseならEMPで無効化されている
+        self.timer = None  # 次の爆弾投下のタイマー
+
+    def update(self, timers: TimerWheel, drops: list["Enemy"]):
+        """
+        敵機を速度ベクトルself.vx, self.vyに基づき移動（左移動）させる
+        ランダムに決めた停止位置_boundまで移動したら，_stateを停止状態に変更し，爆弾投下のタイマーを登録する
+        引数1 timers：爆弾投下のタイマーを登録するTimerWheel
+        引数2 drops：爆弾を投下する敵機を入れるリスト
+        """
+        if self.rect.centerx < self.bound:
             self.vx = 0
+            if self.state != "stop" and self.armed:
+                # フレーム番号がintervalの倍数になるたびに投下するので，その前のフレームの終わりにdropsへ入れる
+                frame = timers.frame
+                self.timer = timers.schedule((frame//self.interval + 1) * self.interval - 1 - frame,
+                                             self.load, timers, drops)
             self.state = "stop"  # 停止状態に変更
         self.rect.move_ip(self.vx, self.vy)
 
+    def load(self, timers: TimerWheel, drops: list["Enemy"]):
+        """
+        次のフレームに爆弾を投下するようdropsに入り，interval後の投下のタイマーを登録する
+        """
+        if self.alive():
+            drops.append(self)
+            self.timer = timers.schedule(self.interval, self.load, timers, drops)
+
+    def disarm(self):
+        """
+        爆弾投下を無効化する
+        """
+        self.armed = False
+        self.interval = float("inf")
+        if self.timer is not None:
+            self.timer.cancel()
+
 class Score:
     """
     スコア表示に関するクラス
     """
     def __init__(self):
-        self.font = pg.font.Font(None, 50)
         self.color = (0, 0, 255)
+        self.text = CachedText(50, self.color, False, glyphs=True)  # スコアは頻繁に変わるのでグリフで組み立てる
         self.value = 0
-        self.image = self.font.render(f"Score: {self.value}", 0, self.color)
+        self.image = self.text.render(f"Score: {self.value}")
         self.rect = self.image.get_rect()
         self.rect.center = 100, HEIGHT-50
  
-    def update(self, screen: pg.Surface):
-        self.image = self.font.render(f"Score: {self.value}", 0, self.color)
-        screen.blit(self.image, self.rect)
+    def update(self, screen: pg.Surface) -> pg.Rect:
+        self.image = self.text.render(f"Score: {self.value}")
+        return screen.blit(self.image, self.rect)
 
 
 class Shield(pg.sprite.Sprite):
     """
     防御壁に関するクラス
     """
-    def __init__(self, bird: Bird, life: int):
+    def __init__(self, bird: Bird, life: int, timers: TimerWheel):
         """
         防御壁を生成する
         引数1 bird：こうかとん
         引数2 life：防御壁の発動時間
+        引数3 timers：防御壁の消滅を登録するTimerWheel
         """
         super().__init__()
         # 空のSurfaceを作成
@@ -383,50 +1421,30 @@ class Shield(pg.sprite.Sprite):
         # offset_y = vy * bird.rect.height
         # self.rect.center = (bird.rect.centerx + offset_x, bird.rect.centery + offset_y)
 
-        # 防御壁の寿命
-        self.life = life
-    
-    def update(self):
-        """
-        防御壁の寿命を管理
-        """
-        self.life -= 1
-        if self.life < 0:
-            self.kill()  # 寿命が尽きたら消滅    
+        # 防御壁の寿命が尽きたら消滅
+        self.timer = timers.schedule(life, self.kill)
 
 
-class EMP(pg.sprite.Sprite):
+class EMP(ScreenEffect):
     """
     電磁パルス（EMP）に関するクラス
     """
-    def __init__(self, bird: Bird, bombs: pg.sprite.Group, emys: pg.sprite.Group):
+    color = (255, 255, 0)  # 半透明の黄色
+    fade = 10
+
+    def __init__(self, bird: Bird, bombs: "BombArray|BombSprites", emys: pg.sprite.Group, timers: TimerWheel):
         """
         EMPを発動し、敵や爆弾を無効化する
         引数: bird: こうかとんインスタンス
-        bombs: 爆弾のグループ
+        bombs: 爆弾の管理クラス
         emys: 敵機のグループ
+        timers: 表示の終わりを登録するTimerWheel
         """
-        super().__init__()
-        self.image = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
-        pg.draw.rect(self.image, (255, 255, 0, 128), (0, 0, WIDTH, HEIGHT))  # 半透明の黄色
-        self.rect = self.image.get_rect()
-        self.life = 10  # 時間表示
-        
+        super().__init__(10, timers)  # 時間表示
         for emy in emys:  # 敵を無効化し、爆弾を遅くする
-            emy.interval = float("inf")  # 爆弾投下を無効化する
-            emy.image = pg.transform.laplacian(emy.image)  # 敵の変更（見た目）
-            emy.image.set_colorkey((0, 0, 0))
-        for bomb in bombs:
-            bomb.speed /= 2  # 爆弾の速度を半減する
-            bomb.state = "inactive" 
-
-    def update(self):
-        """
-        表示時間を管理する
-        """
-        self.life -= 1
-        if self.life < 0:
-            self.kill()
+            emy.disarm()  # 爆弾投下を無効化する
+            emy.image = images.laplacian(emy.image, (0, 0, 0))  # 敵の変更（見た目）
+        bombs.disable()  # 爆弾の速度を半減する
 
 class GuidedBeam(pg.sprite.Sprite):
     """
@@ -440,7 +1458,7 @@ class GuidedBeam(pg.sprite.Sprite):
         """
         super().__init__()
         self.vx, self.vy = 1, 0
-        self.image = pg.transform.rotozoom(pg.image.load(f"fig/beam.png"), 0, 0.9)
+        self.image = images.get("beam.png", zoom=0.9)
         self.rect = self.image.get_rect()
         self.rect.centery = bird.rect.centery
         self.rect.centerx = bird.rect.centerx + bird.rect.width
@@ -465,17 +1483,21 @@ class GuidedBeam(pg.sprite.Sprite):
             self.vx = dx/norm if norm > 0 else 1
             self.vy = dy/norm if norm > 0 else 0
             angle = math.degrees(math.atan2(-self.vy, self.vx))
-            self.image = pg.transform.rotozoom(pg.image.load(f"fig/beam.png"), angle, 0.9)
+            self.image = images.get("beam.png", zoom=0.9, angle=round(angle))
 
-    def update(self, screen: pg.Surface):
+    def update(self):
         """
         誘導ビームを速度ベクトルself.vx, self.vyに基づき移動させる
         """
         self.rect.move_ip(self.speed*self.vx, self.speed*self.vy)
         if check_bound(self.rect) != (True, True):
             self.kill()
-        else:
-            screen.blit(self.image, self.rect)
+
+    def blits(self) -> list[tuple[pg.Surface, pg.Rect]]:
+        """
+        戻り値：誘導ビームの(Surface, 位置)のリスト
+        """
+        return [(self.image, self.rect)]
 
 class Item(pg.sprite.Sprite):
     """
@@ -483,11 +1505,11 @@ class Item(pg.sprite.Sprite):
     """
     # 各アイテムタイプに対応する卵画像を設定
     item_images = {
-        "gravity": "fig/tamago_aka.png",     # 重力場は赤卵
-        "shield": "fig/tamago_ao.png",       # 防御壁は青卵
-        "emp": "fig/tamago_orenge.png",      # EMPはオレンジ卵
-        "hyper": "fig/tamago_midori.png",    # 無敵モードは緑卵
-        "guided": "fig/tamago_mizu.png"      # 誘導ビームは水色卵
+        "gravity": "tamago_aka.png",     # 重力場は赤卵
+        "shield": "tamago_ao.png",       # 防御壁は青卵
+        "emp": "tamago_orenge.png",      # EMPはオレンジ卵
+        "hyper": "tamago_midori.png",    # 無敵モードは緑卵
+        "guided": "tamago_mizu.png"      # 誘導ビームは水色卵
     }
 
     def __init__(self, x: int, y: int, type: str):
@@ -500,11 +1522,9 @@ class Item(pg.sprite.Sprite):
         super().__init__()
         self.type = type
         
-        # 対応する色の卵画像を読み込んでリサイズ
+        # 対応する色の卵画像（30x30にリサイズ済み）を使用
         try:
-            original_image = pg.image.load(self.item_images[type])
-            # 画像のサイズを30x30にリサイズ
-            self.image = pg.transform.scale(original_image, (30, 30))
+            self.image = images.get(self.item_images[type], size=(30, 30))
         except FileNotFoundError:
             # 画像がない場合は従来の四角形を使用
             self.image = pg.Surface((30, 30))
@@ -516,8 +1536,8 @@ class Item(pg.sprite.Sprite):
                 "guided": (0, 255, 255)      # 水色
             }
             pg.draw.rect(self.image, colors[type], (5, 5, 20, 20))
+            self.image.set_colorkey((0, 0, 0))  # 共有のキャッシュ画像は変更しないので，自前の四角形だけ透明色を付ける
             
-        self.image.set_colorkey((0, 0, 0))
         self.rect = self.image.get_rect()
         self.rect.center = WIDTH + 15, y
         self.vx = -5
@@ -542,7 +1562,7 @@ class ItemStock:
             "hyper": 0,
             "guided": 0
         }
-        self.font = pg.font.Font(None, 30)
+        self.texts = {item_type: CachedText(30, (255, 255, 255)) for item_type in self.items}  # 所持数の表示
         
     def add_item(self, item_type: str):
         """
@@ -560,9 +1580,10 @@ class ItemStock:
             return True
         return False
     
-    def draw(self, screen: pg.Surface):
+    def draw(self, screen: pg.Surface) -> pg.Rect:
         """
         アイテムの所持数を画面に表示
+        戻り値：描画した領域
         """
         keys = {
             "gravity": "Enter",
@@ -572,11 +1593,11 @@ class ItemStock:
             "guided": "LShift"
         }
         
+        rects = []
         for i, (item_type, count) in enumerate(self.items.items()):
             try:
-                # 対応する色の卵画像を読み込んでアイコンとして使用
-                original_image = pg.image.load(Item.item_images[item_type])
-                icon = pg.transform.scale(original_image, (20, 20))
+                # 対応する色の卵画像をアイコンとして使用
+                icon = images.get(Item.item_images[item_type], size=(20, 20))
             except FileNotFoundError:
                 # 画像がない場合は従来の四角形を使用
                 icon = pg.Surface((20, 20))
@@ -588,13 +1609,14 @@ class ItemStock:
                     "guided": (0, 255, 255)
                 }
                 pg.draw.rect(icon, colors[item_type], (0, 0, 20, 20))
+                icon.set_colorkey((0, 0, 0))
             
-            icon.set_colorkey((0, 0, 0))
-            screen.blit(icon, (10, 10 + i * 30))
+            rects.append(screen.blit(icon, (10, 10 + i * 30)))
             
             # 所持数の表示
-            text = self.font.render(f"x{count} ({keys[item_type]})", True, (255, 255, 255))
-            screen.blit(text, (35, 10 + i * 30))
+            text = self.texts[item_type].render(f"x{count} ({keys[item_type]})")
+            rects.append(screen.blit(text, (35, 10 + i * 30)))
+        return rects[0].unionall(rects[1:])
 class Health:
     """
     こうかとんのHPを管理するクラス
@@ -602,8 +1624,8 @@ class Health:
     def __init__(self, max_hp=100):
         self.max_hp = max_hp
         self.current_hp = max_hp
-        self.font = pg.font.Font(None, 50)
         self.color = (255, 0, 0)  # 赤色でHPを表示
+        self.text = CachedText(50, self.color, glyphs=True)
 
     def take_damage(self, damage):
         """
@@ -612,12 +1634,13 @@ class Health:
         self.current_hp -= damage
         self.current_hp = max(self.current_hp, 0)  # HP制限
 
-    def update(self, screen: pg.Surface):
+    def update(self, screen: pg.Surface) -> pg.Rect:
         """
         画面に現在のHPを表示
+        戻り値：描画した領域
         """
-        hp_text = self.font.render(f"HP: {self.current_hp}/{self.max_hp}", True, self.color)
-        screen.blit(hp_text, (WIDTH - 200, HEIGHT - 110))
+        hp_text = self.text.render(f"HP: {self.current_hp}/{self.max_hp}")
+        return screen.blit(hp_text, (WIDTH - 200, HEIGHT - 110))
 
 class Clear_item(pg.sprite.Sprite):
     """
@@ -625,29 +1648,32 @@ class Clear_item(pg.sprite.Sprite):
     右側から流れてくるjewelを4つすべて取得するとゲームクリアになる
     """
 
-    def __init__(self):
+    def __init__(self, rng=random):
         """
         引数に基づきアイテム画像Surfaceを生成する
-        引数 xy：アイテム画像の中心座標タプル
+        引数 rng：乱数生成器
         """
         super().__init__()
         self.cpoint = 0
         self.cpointmax = 4
-        self.ci_imgs = [pg.image.load(f"fig/jewel0{i}.png") for i in range(1, 4)]
-        self.image = random.choice(self.ci_imgs)
-        self.image = pg.transform.rotozoom(self.image, 0, 0.4)
+        self.ci_imgs = [f"jewel0{i}.png" for i in range(1, 4)]
+        self.image = images.get(rng.choice(self.ci_imgs), zoom=0.4)
         self.rct = self.image.get_rect()
-        self.rct.center = WIDTH, random.randint(0, HEIGHT)
+        self.rct.center = WIDTH, rng.randint(0, HEIGHT)
+        self.rect = self.rct  # Lifecycleなどpg.spriteの流儀で扱うための別名
         self.vx, self.vy = -5, 0
 
-    def update(self, screen: pg.Surface):
+    def update(self):
         """
         アイテムを速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
         """
-       
         self.rct.move_ip(self.vx, self.vy)
-        screen.blit(self.image, self.rct)
+
+    def blits(self) -> list[tuple[pg.Surface, pg.Rect]]:
+        """
+        戻り値：アイテムの(Surface, 位置)のリスト
+        """
+        return [(self.image, self.rct)]
 
 class Jewel_num(pg.sprite.Sprite):
     """
@@ -658,18 +1684,18 @@ class Jewel_num(pg.sprite.Sprite):
         引数に基づきjewel数表示画像Surfaceを生成する
         引数 xy：jewel数表示画像の中心座標タプル
         """
-        self.font = pg.font.Font(None, 50)
         self.color = (0, 0, 255)
+        self.text = CachedText(50, self.color, False)
         self.cpoint = Clear_item().cpoint
         self.cpointmax = Clear_item().cpointmax
-        self.image = self.font.render(f"jewel:{self.cpoint}/{self.cpointmax}", 0, self.color)
+        self.image = self.text.render(f"jewel:{self.cpoint}/{self.cpointmax}")
         self.rect = self.image.get_rect()
         self.rect.center = WIDTH-100, HEIGHT-150
 
-    def update(self, screen: pg.Surface, cpoint: int):
+    def update(self, screen: pg.Surface, cpoint: int) -> pg.Rect:
         self.cpoint = cpoint
-        self.image = self.font.render(f"jewel:{self.cpoint}/{self.cpointmax}", 0, self.color)
-        screen.blit(self.image, self.rect)
+        self.image = self.text.render(f"jewel:{self.cpoint}/{self.cpointmax}")
+        return screen.blit(self.image, self.rect)
     
 class Obstacle(pg.sprite.Sprite):
     """
@@ -677,8 +1703,7 @@ class Obstacle(pg.sprite.Sprite):
     """
     def __init__(self):
         super().__init__()
-        self.image = pg.image.load("fig/toge.png")  # toge.pngを読み込む
-        self.image = pg.transform.scale(self.image, (50, 50))  # 画像をリサイズする
+        self.image = images.get("toge.png", size=(50, 50))  # リサイズ済みのtoge.png
         self.rect = self.image.get_rect()
         self.rect.centerx = WIDTH + 50  # 初期位置を右端に設定
         self.vx = -6  # 左方向に移動
@@ -688,259 +1713,1556 @@ class Obstacle(pg.sprite.Sprite):
         if self.rect.right < 0:
             self.kill()
 
-def create_obstacle_wall():
+class ObstacleWall(pg.sprite.Sprite):
     """
-    障害物を縦に連ねて壁のようにする関数
+    障害物を縦に連ねた壁をひとつのスプライトとして扱うクラス
+    壁の画像は残っている障害物の並びごとに一度だけ描画し，同じ並びの壁で共有する
     """
-    wall = pg.sprite.Group()
-    gap_start = random.randint(0, HEIGHT - 150)  # ランダムに隙間の開始位置を決定
-    for i in range(25, HEIGHT, 50):  # 50ピクセル間隔で縦に連ねる
-        if not (gap_start <= i < gap_start + 150):  # 3つ分の隙間を作成
+    size = 50  # 障害物1つの大きさ
+    imgs = {}  # 障害物の中心y座標のタプル -> 壁の画像
+
+    def __init__(self, gap_start: int):
+        """
+        引数 gap_start：隙間の開始位置のy座標
+        """
+        super().__init__()
+        # 50ピクセル間隔で縦に連ね，3つ分の隙間を作成
+        self.tiles = [i for i in range(25, HEIGHT, 50) if not (gap_start <= i < gap_start + 150)]
+        self.image = __class__.render(self.tiles)
+        self.rect = self.image.get_rect()
+        self.rect.centerx = WIDTH + 50  # 初期位置を右端に設定
+        self.vx = -6  # 左方向に移動
+
+    @classmethod
+    def render(cls, tiles: list[int]) -> pg.Surface:
+        """
+        障害物を並べた壁の画像を返す（同じ並びなら作成済みの画像を返す）
+        引数 tiles：障害物の中心y座標のリスト
+        """
+        key = tuple(tiles)
+        img = cls.imgs.get(key)
+        if img is None:
+            img = pg.Surface((cls.size, HEIGHT), pg.SRCALPHA)
+            tile = images.get("toge.png", size=(cls.size, cls.size))
+            img.blits([(tile, (0, y - cls.size//2)) for y in tiles], doreturn=False)
+            cls.imgs[key] = img
+        return img
+
+    def hit(self, rect: pg.Rect, mask: pg.mask.Mask | None = None) -> list[Obstacle]:
+        """
+        rectと重なる障害物を壁から取り除き，取り除いた障害物を返す
+        x方向の重なりは判定済みとし，y方向は障害物の中心座標を二分探索して調べる
+        引数1 rect：判定する矩形（こうかとんのRect）
+        引数2 mask：rectの位置にある画像のMask（指定すると矩形が重なった障害物のうち画素も重なるものだけを取り除く）
+        """
+        half = __class__.size // 2
+        lo = bisect.bisect_right(self.tiles, rect.top - half)  # 下端がrect.topより下にある最初の障害物
+        hi = bisect.bisect_left(self.tiles, rect.bottom + half)  # 上端がrect.bottomより上にある最後の障害物
+        if lo >= hi:
+            return []  # 隙間を通過中
+        hit_tiles = self.tiles[lo:hi]
+        if mask is not None:
+            tile_mask = images.mask(images.get("toge.png", size=(__class__.size, __class__.size)))
+            hit_tiles = [y for y in hit_tiles if mask.overlap(tile_mask, (self.rect.left - rect.x, y - half - rect.y))]
+            if not hit_tiles:
+                return []
+        hits = []
+        for y in hit_tiles:
             obstacle = Obstacle()
-            obstacle.rect.centery = i
-            wall.add(obstacle)
-    return wall
+            obstacle.rect.center = self.rect.centerx, y
+            hits.append(obstacle)
+        if mask is None:
+            del self.tiles[lo:hi]
+        else:
+            self.tiles = [y for y in self.tiles if y not in hit_tiles]
+        if self.tiles:
+            self.image = __class__.render(self.tiles)
+        else:
+            self.kill()
+        return hits
 
+    def update(self):
+        self.rect.move_ip(self.vx, 0)
+        if self.rect.right < 0:
+            self.kill()
+
+
+def create_obstacle_wall(rng=random) -> ObstacleWall:
+    """
+    障害物を縦に連ねて壁のようにする関数
+    引数 rng：乱数生成器
+    """
+    gap_start = rng.randint(0, HEIGHT - 150)  # ランダムに隙間の開始位置を決定
+    return ObstacleWall(gap_start)
 
-def main():
-    pg.display.set_caption("シューティングこうかとん")
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
-    bg_img = pg.image.load("fig/pg_bg.jpg")
-    flip_bg_img = pg.transform.flip(bg_img, True, False)
-    score = Score()
-    item_stock = ItemStock()  # アイテム所持管理クラスのインスタンス化
-    cpoint = Clear_item().cpoint
-    cpointmax = Clear_item().cpointmax
-    jewel_num = Jewel_num()
-
-    bird = Bird(3, (100, HEIGHT//2))
-    charge_bar = ChargeBar()  # チャージバーのインスタンス
-    beams = pg.sprite.Group()
-    clock = pg.time.Clock()
-    exps = pg.sprite.Group()
-    charging = False
 
-    bombs = pg.sprite.Group()
-    emys = pg.sprite.Group()
-    shields = pg.sprite.Group()  # 防御壁グループを追加
-    emps = pg.sprite.Group()  # EMPのグループ
-    items = pg.sprite.Group()  # アイテムグループを追加
-    gravity_group = pg.sprite.Group()
-    citem = pg.sprite.Group()
-    obstacles = pg.sprite.Group()  # 障害物グループを追加
+class BackgroundLayer:
+    """
+    背景画像と左右反転画像をつなげた帯を横スクロールさせる背景レイヤーに関するクラス
+    """
+    strips = {}  # (画像, 反転画像, y) -> 帯Surface（リスタートしても作り直さない）
 
-    tmr = 0
-    emps.update()  # EMPの更新と描画を追加
-    emps.draw(screen)
+    def __init__(self, img: pg.Surface, flip_img: pg.Surface, speed: float, y: int = 0):
+        """
+        画像と反転画像をつなげて継ぎ目のない帯Surfaceを生成する
+        引数1 img：背景画像
+        引数2 flip_img：左右反転した背景画像
+        引数3 speed：1フレームあたりのスクロール量[px]
+        引数4 y：レイヤーを描画するy座標
+        """
+        self.strip = __class__.strips.get((img, flip_img, y))
+        if self.strip is None:
+            w, h = img.get_width(), min(img.get_height(), HEIGHT - y)  # 画面外の行は持たない
+            flags = pg.SRCALPHA if img.get_flags() & pg.SRCALPHA else 0
+            self.strip = pg.Surface((w*2, h), flags)
+            self.strip.blit(img, (0, 0))
+            self.strip.blit(flip_img, (w, 0))
+            if pg.display.get_surface() is not None:
+                self.strip = self.strip.convert_alpha() if flags else self.strip.convert()
+            __class__.strips[(img, flip_img, y)] = self.strip
+        self.speed = speed
+        self.y = y
+
+    def draw(self, screen: pg.Surface, tmr: float) -> int:
+        """
+        画面に見えている1～2枚分の切り出しだけを転送する
+        引数1 screen：画面Surface
+        引数2 tmr：経過tick数（tickの間を補間して描くときは小数）
+        戻り値：転送した画素数
+        """
+        strip_w, h = self.strip.get_size()
+        x = int(tmr*self.speed) % strip_w  # 帯の周期で折り返すので継ぎ目で跳ばない
+        first_w = min(WIDTH, strip_w - x)
+        screen.blit(self.strip, (0, self.y), (x, 0, first_w, h))
+        if first_w < WIDTH:  # 帯の右端をまたぐ場合は先頭から残りを転送
+            screen.blit(self.strip, (first_w, self.y), (0, 0, WIDTH - first_w, h))
+        return WIDTH * h
 
 
-    clock = pg.time.Clock()
-    gravity_group = pg.sprite.Group()  # Gravityインスタンスを管理するグループ
+class Background:
+    """
+    速度の異なる背景レイヤーを奥から順に重ねる多重スクロール背景に関するクラス
+    """
+    def __init__(self, layers: list[BackgroundLayer]):
+        self.layers = layers  # 奥のレイヤーから順に並べる
+        self.pixels = 0  # 直近のフレームで転送した画素数
+
+    @property
+    def scrolling(self) -> bool:
+        """
+        スクロールするレイヤーがあるかどうか
+        """
+        return any(layer.speed for layer in self.layers)
+
+    def draw(self, screen: pg.Surface, tmr: float):
+        """
+        すべてのレイヤーを描画する
+        引数1 screen：画面Surface
+        引数2 tmr：経過tick数（tickの間を補間して描くときは小数）
+        """
+        self.pixels = sum(layer.draw(screen, tmr) for layer in self.layers)
+
+
+CRITICAL_IMAGES = ("pg_bg.jpg", "3.png")  # 最初の画面を出すのに必要な画像（背景とこうかとん）
+
+
+def image_specs() -> list[tuple[str, dict]]:
+    """
+    ゲーム中に使う画像の(ファイル名, ImageCache.get()のキーワード引数)のリスト
+    """
+    specs = [
+        ("pg_bg.jpg", {}),
+        ("pg_bg.jpg", {"flip": (True, False)}),
+        ("3.png", {"zoom": 0.9, "flip": (True, False)}),
+        ("8.png", {"zoom": 1.7}),
+        ("100.png", {"zoom": 0.3}),
+        ("beam.png", {}),
+        ("beam.png", {"zoom": 0.9}),
+        ("BEEM1.png", {"size": (300, 75)}),
+        ("explosion.gif", {}),
+        ("explosion.gif", {"flip": (True, True)}),
+        ("kirakira.png", {}),
+        ("kirakira.png", {"flip": (True, True)}),
+        ("toge.png", {"size": (50, 50)}),
+    ]
+    specs += [(name, {}) for name in Enemy.imgs]
+    specs += [(f"jewel0{i}.png", {"zoom": 0.4}) for i in range(1, 4)]
+    for name in Item.item_images.values():
+        specs += [(name, {"size": (30, 30)}), (name, {"size": (20, 20)})]
+    return specs
+
+
+def image_manifest() -> list[str]:
+    """
+    ゲーム中に使うfig/内の画像ファイルの一覧（最初の画面に必要な画像が先頭）
+    """
+    return list(dict.fromkeys([*CRITICAL_IMAGES, *(name for name, _ in image_specs())]))
+
+
+def preload_steps():
+    """
+    preload_images()の処理を小さな手順に分けて進めるジェネレーター
+    各手順の前に，その手順で使う画像ファイル名（使わなければNone）をyieldする
+    """
+    for name, kwargs in image_specs():
+        yield name
+        images.get(name, **kwargs)
+    for name in Enemy.imgs:  # EMPで無効化された敵機
+        yield name
+        images.laplacian(images.get(name), (0, 0, 0))
+    for angle in range(-180, 181):  # 誘導ビームは進む向きの角度（整数）ごと
+        if angle % 60 == 0:
+            yield "beam.png"
+        images.get("beam.png", zoom=0.9, angle=angle)
+    yield None
+    for effect in (Gravity, EMP):  # 画面全体のエフェクト
+        effect.overlay()
+    for rad in Bomb.radii:  # 爆弾円は半径と色の組ごと
+        for color in Bomb.colors:
+            images.mask(Bomb.render(rad, color))
+    # 精密な衝突判定に使うMask（こうかとんは通常と無敵モードの画像）
+    yield "3.png"
+    bird_imgs = [images.get("3.png", zoom=0.9, flip=(True, False))]
+    for _ in range(Bird.hyper_frames):
+        bird_imgs.append(images.laplacian(bird_imgs[-1]))
+    for img in bird_imgs:
+        images.mask(img)
+    yield "toge.png"
+    images.mask(images.get("toge.png", size=(50, 50)))
+    for i in range(1, 4):
+        yield f"jewel0{i}.png"
+        images.mask(images.get(f"jewel0{i}.png", zoom=0.4))
+    for name in Item.item_images.values():
+        yield name
+        images.mask(images.get(name, size=(30, 30)))
+    for gap_start in range(0, HEIGHT - 150 + 1):  # 隙間の位置ごとの壁の画像
+        if gap_start % 50 == 0:
+            yield "toge.png"
+        ObstacleWall(gap_start)
+
+
+def preload_images():
+    """
+    ゲーム中に使う画像をすべて画像キャッシュに読み込む（set_mode()の後に呼ぶこと）
+    """
+    for _ in preload_steps():
+        pass
+    images.preloaded = True
+
+
+class Broadphase:
+    """
+    衝突判定の候補をグループから絞り込むブロードフェーズの基底クラス
+    query()はグループ内の順番で結果を返すので，pg.sprite.spritecollide/groupcollideと同じ結果になる
+    """
+    def __init__(self, group: pg.sprite.AbstractGroup):
+        """
+        引数 group：判定対象のスプライトのグループ（フレームごとに作り直す）
+        """
+        self.group = group
+        self.sprites = group.sprites()  # 作成時のグループ内の順番
+        self.members = group.spritedict  # 判定中にkillされたスプライトを除くための所属確認用
+
+    def query(self, rect: pg.Rect) -> list[pg.sprite.Sprite]:
+        """
+        rectと重なっているグループ内のスプライトを，グループ内の順番で返す
+        """
+        raise NotImplementedError
+
+    def scan(self, rect: pg.Rect) -> list[pg.sprite.Sprite]:
+        """
+        すべてのスプライトを順に調べる総当たりの判定
+        """
+        colliderect, members = rect.colliderect, self.members
+        return [sprite for sprite in self.sprites if colliderect(sprite.rect) and sprite in members]
+
+    def spritecollide(self, sprite: pg.sprite.Sprite, dokill: bool, collided=None) -> list[pg.sprite.Sprite]:
+        """
+        pg.sprite.spritecollide(sprite, group, dokill, collided)と同じ判定を行う
+        collided（collide_maskなど）は矩形が重なったスプライトにだけ使う
+        """
+        hits = self.query(sprite.rect)
+        if collided is not None:
+            hits = [hit for hit in hits if collided(sprite, hit)]
+        if dokill:
+            for hit in hits:
+                hit.kill()
+        return hits
+
+    def groupcollide(self, groupa: pg.sprite.AbstractGroup, dokilla: bool, dokillb: bool) -> dict:
+        """
+        pg.sprite.groupcollide(groupa, group, dokilla, dokillb)と同じ判定を行う
+        """
+        crashed = {}
+        for sprite in groupa.sprites():
+            hits = self.spritecollide(sprite, dokillb)
+            if hits:
+                crashed[sprite] = hits
+                if dokilla:
+                    sprite.kill()
+        return crashed
+
 
-    while True:
-        key_lst = pg.key.get_pressed()
-        for event in pg.event.get():
+class BruteForce(Broadphase):
+    """
+    すべてのスプライトと矩形を比較する（従来のpg.spriteの判定と同じ総当たり）
+    """
+    def query(self, rect: pg.Rect) -> list[pg.sprite.Sprite]:
+        return self.scan(rect)
+
+
+class SpatialHash(Broadphase):
+    """
+    画面を一様なグリッドに分け，矩形が重なるセルにいるスプライトだけを候補にするブロードフェーズ
+    グリッドは数回問い合わせがあってから作る（1～2回の判定なら総当たりの方が速いため）
+    """
+    cell = 64  # セルの一辺[px]
+    min_size = 32  # これより少ないグループはグリッドを作らず総当たりで判定する
+    min_queries = 3  # グリッドを作るまでの問い合わせ回数
+
+    def __init__(self, group: pg.sprite.AbstractGroup):
+        super().__init__(group)
+        self.cells = None  # (セルx, セルy) -> [(グループ内の順番, スプライト)]
+        self.queries = 0
+
+    def _build(self):
+        cell = __class__.cell
+        self.cells = collections.defaultdict(list)
+        for order, sprite in enumerate(self.sprites):
+            rect = sprite.rect
+            for cx in range(rect.left // cell, (rect.right - 1) // cell + 1):
+                for cy in range(rect.top // cell, (rect.bottom - 1) // cell + 1):
+                    self.cells[(cx, cy)].append((order, sprite))
+
+    def query(self, rect: pg.Rect) -> list[pg.sprite.Sprite]:
+        if self.cells is None:
+            self.queries += 1
+            if len(self.sprites) < __class__.min_size or self.queries < __class__.min_queries:
+                return self.scan(rect)
+            self._build()
+        cell = __class__.cell
+        x0, x1 = rect.left // cell, (rect.right - 1) // cell
+        y0, y1 = rect.top // cell, (rect.bottom - 1) // cell
+        if x0 == x1 and y0 == y1:  # 1つのセルに収まる場合は登録順のまま使える
+            candidates = self.cells.get((x0, y0), ())
+        elif (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.sprites):  # 画面全体のような大きな矩形は総当たりの方が速い
+            return self.scan(rect)
+        else:
+            found = {}
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    for order, sprite in self.cells.get((cx, cy), ()):
+                        found[order] = sprite
+            candidates = sorted(found.items())
+        colliderect, members = rect.colliderect, self.members
+        return [sprite for _, sprite in candidates if colliderect(sprite.rect) and sprite in members]
+
+
+class SweepAndPrune(Broadphase):
+    """
+    スプライトを左端のx座標でソートし，x方向に重なり得る範囲だけを候補にするブロードフェーズ
+    横スクロールで縦に長い配置（障害物の壁など）でも候補が増えにくい
+    """
+    def __init__(self, group: pg.sprite.AbstractGroup):
+        super().__init__(group)
+        self.entries = sorted(((sprite.rect.left, order, sprite) for order, sprite in enumerate(self.sprites)),
+                              key=lambda entry: entry[:2])
+        self.lefts = [entry[0] for entry in self.entries]
+        self.max_width = max((entry[2].rect.width for entry in self.entries), default=0)
+
+    def query(self, rect: pg.Rect) -> list[pg.sprite.Sprite]:
+        lo = bisect.bisect_right(self.lefts, rect.left - self.max_width)  # 右端がrect.leftより右にあり得る最初
+        hi = bisect.bisect_left(self.lefts, rect.right)  # 左端がrect.rightより左にある最後
+        colliderect, members = rect.colliderect, self.members
+        hits = [(order, sprite) for _, order, sprite in self.entries[lo:hi]
+                if colliderect(sprite.rect) and sprite in members]
+        hits.sort(key=lambda hit: hit[0])
+        return [sprite for _, sprite in hits]
+
+
+BROADPHASES = {"brute": BruteForce, "grid": SpatialHash, "sap": SweepAndPrune}
+
+
+class FrameProfiler:
+    """
+    1フレームを処理段階（イベント取得，衝突判定，描画など）に分けて時間を計測するクラス
+    直近のフレームの平均を画面右上に重ねて表示し，毎フレームの計測値をCSVに書き出せる
+    """
+    phases = ("poll", "assets", "input", "spawn", "collide", "update", "background", "draw", "hud", "display", "wait")
+
+    def __init__(self, overlay: bool = False, csv_path: str | None = None, window: int = 60):
+        """
+        引数1 overlay：Trueなら計測結果を画面に重ねて表示する
+        引数2 csv_path：毎フレームの計測値を書き出すCSVファイル名
+        引数3 window：表示する平均をとるフレーム数
+        """
+        self.overlay = overlay
+        self.csv_file = None
+        self.csv_writer = None
+        if csv_path is not None:
+            self.csv_file = open(csv_path, "w", newline="")
+            self.csv_writer = csv.writer(self.csv_file)
+        self.history = collections.deque(maxlen=window)  # 直近のフレームの計測値
+        self.counts = {}  # 直近のフレームのグループごとのエンティティ数
+        self.current = {}
+        self.last = 0.0
+        self.frame = 0
+        self.texts = []  # オーバーレイの各行のCachedText
+        self.panel = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.overlay or self.csv_writer is not None
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.history.clear()
+
+    def begin(self):
+        """
+        フレームの計測を開始する
+        計測していないときも値を用意しておき，フレームの途中でtoggle_overlay()されても続きを計測できるようにする
+        """
+        self.current = dict.fromkeys(__class__.phases, 0.0)
+        self.last = time.perf_counter()
+
+    def mark(self, phase: str):
+        """
+        直前のmark（またはbegin）からの経過時間を処理段階phaseの時間に加算する
+        """
+        if self.enabled:
+            now = time.perf_counter()
+            self.current[phase] += (now - self.last) * 1000
+            self.last = now
+
+    def end(self, counts: dict[str, int]):
+        """
+        フレームの計測を終了し，履歴とCSVに記録する
+        引数 counts：グループごとのエンティティ数
+        """
+        if not self.enabled:
+            return
+        self.history.append(self.current)
+        self.counts = counts
+        if self.csv_writer is not None:
+            if self.frame == 0:
+                self.csv_writer.writerow(["frame", *__class__.phases, "total", *counts])
+            row = [self.current[phase] for phase in __class__.phases]
+            self.csv_writer.writerow([self.frame, *(f"{ms:.4f}" for ms in row), f"{sum(row):.4f}", *counts.values()])
+        self.frame += 1
+
+    def draw(self, screen: pg.Surface) -> pg.Rect | None:
+        """
+        直近のフレームの平均時間とエンティティ数を画面右上に表示する
+        引数 screen：画面Surface
+        戻り値：描画した領域
+        """
+        if not self.overlay or not self.history:
+            return None
+        means = {phase: sum(f[phase] for f in self.history) / len(self.history) for phase in __class__.phases}
+        lines = [(phase, f"{ms:.2f} ms") for phase, ms in means.items()]
+        lines.append(("total", f"{sum(means.values()):.2f} ms"))
+        lines += [(name, str(num)) for name, num in self.counts.items()]
+        while len(self.texts) < len(lines):  # (項目名, 値)のCachedText
+            self.texts.append((CachedText(20, (255, 255, 255)), CachedText(20, (255, 255, 255), glyphs=True)))
+        if self.panel is None or self.panel.get_height() != len(lines) * 16 + 10:
+            self.panel = pg.Surface((180, len(lines) * 16 + 10), pg.SRCALPHA)
+            self.panel.fill((0, 0, 0, 160))
+        rect = screen.blit(self.panel, (WIDTH - 190, 10))
+        seq = []
+        for i, ((label_text, value_text), (label, value)) in enumerate(zip(self.texts, lines)):
+            y = rect.y + 5 + i * 16
+            value_img = value_text.render(value)
+            seq.append((label_text.render(label), (rect.x + 8, y)))
+            seq.append((value_img, (rect.right - 8 - value_img.get_width(), y)))  # 値は右揃え
+        screen.blits(seq, doreturn=False)
+        return rect
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = self.csv_writer = None
+
+
+class Lifecycle:
+    """
+    画面外に出たエンティティを消し，増え続けるグループを警告するクラス
+    """
+    def __init__(self, margin: int = 100, interval: int = 10, leak_seconds: int = 30, leak_growth: int = 5,
+                 fps: int = TICK_RATE):
+        """
+        引数1 margin：画面の外側にこれ以上離れたエンティティを消す[px]
+        引数2 interval：画面外の判定を行う間隔[フレーム]
+        引数3 leak_seconds：この秒数の間一度も減らずに増え続けたグループを警告する
+        引数4 leak_growth：警告する増加数の下限（少し増えただけのグループは警告しない）
+        引数5 fps：1秒あたりのtick数（シミュレーションの回数）
+        """
+        self.area = pg.Rect(0, 0, WIDTH, HEIGHT).inflate(2*margin, 2*margin)
+        self.interval = interval
+        self.leak_growth = leak_growth
+        self.fps = fps
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=leak_seconds+1))  # 名前 -> 1秒ごとの数
+        self.leaks = set()  # 警告中のグループ名
+        self.culled = 0  # 消したエンティティの数
+
+    def is_gone(self, sprite: pg.sprite.Sprite) -> bool:
+        """
+        spriteが画面からmargin以上離れ，さらに遠ざかる向き（または止まっている）ならTrueを返す
+        """
+        rect, area = sprite.rect, self.area
+        if area.colliderect(rect):
+            return False
+        vx, vy = getattr(sprite, "vx", 0), getattr(sprite, "vy", 0)
+        return ((rect.right <= area.left and vx <= 0) or (area.right <= rect.left and vx >= 0) or
+                (rect.bottom <= area.top and vy <= 0) or (area.bottom <= rect.top and vy >= 0))
+
+    def cull(self, groups: list[pg.sprite.AbstractGroup], tmr: int):
+        """
+        interval フレームごとに，画面外に出て戻ってこないエンティティを消す
+        引数1 groups：判定するグループのリスト
+        引数2 tmr：経過フレーム数
+        """
+        if tmr % self.interval:
+            return
+        for group in groups:
+            for sprite in [sprite for sprite in group if self.is_gone(sprite)]:
+                sprite.kill()
+                self.culled += 1
+
+    def due(self, tmr: int) -> bool:
+        """
+        グループの数を記録するフレーム（1秒ごと）ならTrueを返す
+        引数 tmr：経過フレーム数
+        """
+        return tmr % self.fps == 0
+
+    def check(self, counts: dict[str, int], tmr: int):
+        """
+        1秒ごとにグループの数を記録し，leak_seconds秒の間一度も減らずにleak_growth以上増えたグループを警告する
+        引数1 counts：グループごとのエンティティ数
+        引数2 tmr：経過フレーム数
+        """
+        if not self.due(tmr):
+            return
+        for name, count in counts.items():
+            samples = self.samples[name]
+            samples.append(count)
+            growing = (len(samples) == samples.maxlen and samples[-1] - samples[0] >= self.leak_growth and
+                       all(a <= b for a, b in zip(samples, list(samples)[1:])))
+            if growing and name not in self.leaks:
+                self.leaks.add(name)
+                print(f"warning: {name} has grown from {samples[0]} to {samples[-1]} "
+                      f"over {samples.maxlen-1} s (frame {tmr})", file=sys.stderr)
+            elif len(samples) > 1 and samples[-1] < samples[-2]:
+                self.leaks.discard(name)  # 減ったらまた警告できるようにする
+
+
+def default_level(balance: dict) -> dict:
+    """
+    従来の出現ルール（一定間隔で敵機・jewel・アイテム・壁を出す）をレベルの形式で返す
+    引数 balance：World.balanceと同じ形式の辞書
+    """
+    return {
+        "name": "classic",
+        "waves": [{
+            "start": 0,
+            "spawns": [
+                {"type": "jewel", "every": balance["jewel_every"], "chance": 0.2},
+                {"type": "item", "every": balance["item_every"]},
+                {"type": "enemy", "every": balance["enemy_every"]},
+                {"type": "wall", "every": balance["wall_every"]},
+            ],
+        }],
+    }
+
+
+def load_level(path: str) -> dict:
+    """
+    レベルファイル（JSON）を読み込む
+    {"name": 名前, "waves": [{"start": 開始フレーム, "end": 終了フレーム, "difficulty": [開始時, 終了時],
+                              "spawns": [出現ルール, ...]}, ...]}
+    出現ルール：{"type": "enemy"|"jewel"|"item"|"wall", "offset": ウェーブ開始からの最初の出現フレーム,
+                 "every": 間隔, "jitter": 間隔の揺らぎ, "count": 出現回数の上限, "amount": 1回の出現数,
+                 "chance": 出現確率}（type以外は省略可）
+    """
+    with open(path) as f:
+        level = json.load(f)
+    SpawnScheduler(level, random.Random())  # 形式を確かめる
+    return level
+
+
+class SpawnScheduler:
+    """
+    レベルの出現ルールを(次の出現フレーム, ルールの順番, ルール)のヒープで管理するクラス
+    毎フレームの処理はヒープの先頭との比較1回だけで，ルールがいくつあっても変わらない
+    """
+    types = ("jewel", "item", "enemy", "wall")  # 出現させられるもの
+
+    def __init__(self, level: dict, rng=random):
+        """
+        引数1 level：レベルの辞書（load_level()，default_level()の戻り値）
+        引数2 rng：間隔の揺らぎに使う乱数生成器
+        """
+        self.rng = rng
+        self.heap = []
+        for wave in level["waves"]:
+            for spawn in wave["spawns"]:
+                if spawn.get("type") not in __class__.types:
+                    raise ValueError(f"unknown spawn type: {spawn.get('type')!r}")
+                rule = {"offset": 0, "every": None, "jitter": 0, "count": None, "amount": 1, "chance": 1.0,
+                        **spawn, "wave": wave, "fired": 0}
+                heapq.heappush(self.heap, (wave.get("start", 0) + rule["offset"], len(self.heap), rule))
+
+    def difficulty(self, wave: dict, tmr: int) -> float:
+        """
+        ウェーブのdifficulty [開始時, 終了時]を経過に応じて線形に補間した難易度を返す（終了がなければ開始時の値）
+        """
+        first, last = wave.get("difficulty", [1.0, 1.0])
+        start, end = wave.get("start", 0), wave.get("end")
+        if end is None or end <= start:
+            return first
+        return first + (last - first) * min(1.0, max(0.0, (tmr - start) / (end - start)))
+
+    def due(self, tmr: int) -> list[dict]:
+        """
+        tmrまでに出現時刻が来たルールを返し，繰り返すルールは次の出現時刻で入れ直す
+        引数 tmr：経過フレーム数
+        """
+        heap = self.heap
+        if not heap or heap[0][0] > tmr:
+            return []
+        rules = []
+        while heap and heap[0][0] <= tmr:
+            _, order, rule = heapq.heappop(heap)
+            rules.append(rule)
+            rule["fired"] += 1
+            if rule["every"] is None or (rule["count"] is not None and rule["fired"] >= rule["count"]):
+                continue  # 繰り返さない
+            interval = rule["every"] / self.difficulty(rule["wave"], tmr)
+            if rule["jitter"]:
+                interval += self.rng.randint(-rule["jitter"], rule["jitter"])
+            next_tmr = tmr + max(1, round(interval))
+            end = rule["wave"].get("end")
+            if end is None or next_tmr < end:
+                heapq.heappush(heap, (next_tmr, order, rule))
+        return rules
+
+
+class World:
+    """
+    ゲームの状態をまとめて持ち，入力から1フレーム分のシミュレーションを進めるクラス
+    描画はdraw()に分けてあるので，画面がなくてもstep()だけでゲームを進められる
+    """
+    balance = {  # ゲームバランスの定数（batch.pyで値を振って調整する）
+        "enemy_every": 200,  # 敵機を出現させる間隔[フレーム]
+        "jewel_every": 200,  # jewelの出現を抽選する間隔[フレーム]
+        "item_every": 300,  # アイテムを出現させる間隔[フレーム]
+        "wall_every": 225,  # 障害物の壁を出現させる間隔[フレーム]
+        "bomb_interval": (50, 300),  # 敵機の爆弾投下間隔の範囲[フレーム]
+        "bomb_speed": 6,  # 爆弾の速さ
+    }
+    spawn_balance = ("enemy_every", "jewel_every", "item_every", "wall_every")  # levelを指定すると使わない出現間隔
+
+    def __init__(self, headless: bool = False, scroll: bool = True, seed: int | None = None,
+                 profiler: "FrameProfiler | None" = None, broadphase: str = "grid", bombs: str = "array",
+                 balance: dict | None = None, level: dict | None = None, precise: bool = False,
+                 interpolate: bool = False):
+        """
+        引数1 headless：Trueなら描画用の背景やHUDを作らない
+        引数2 scroll：Falseなら背景をスクロールさせない
+        引数3 seed：このゲーム専用の乱数のシード（Noneならランダムに決める）
+        引数4 profiler：処理段階ごとの時間を計測するFrameProfiler（Noneなら計測しない）
+        引数5 broadphase：衝突判定のブロードフェーズ（"grid"，"sap"，"brute"）
+        引数6 bombs：爆弾の管理方式（"array"：NumPy配列，"sprite"：スプライト）
+        引数7 balance：World.balanceのうち変更する値（levelを指定したときはspawn_balanceの値は変更できない）
+        引数8 level：出現ルールを定めるレベル（Noneならbalanceの間隔で出す従来のルール）
+        引数9 precise：Trueならこうかとんと爆弾・障害物・アイテム・jewelの判定で，矩形が重なった組の画素も比べる
+        引数10 interpolate：Trueなら毎tickの前に位置を記録し，draw()でtickの間の位置を補間して描けるようにする
+        """
+        unknown = set(balance or {}) - set(__class__.balance)
+        if unknown:
+            raise ValueError(f"unknown balance parameter: {', '.join(sorted(unknown))}")
+        ignored = set(balance or {}) & set(__class__.spawn_balance) if level is not None else set()
+        if ignored:  # 出現はレベルのウェーブで決まるので，出現間隔を変えても効かない
+            raise ValueError(f"balance parameter not used with a level: {', '.join(sorted(ignored))}")
+        self.balance = {**__class__.balance, **(balance or {})}
+        self.broadphase = BROADPHASES[broadphase]
+        if np is None:  # NumPyがなければ配列では管理できない
+            bombs = "sprite"
+        self.profiler = FrameProfiler() if profiler is None else profiler
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self.rng = random.Random(self.seed)  # 出現や爆弾などゲーム内の乱数はすべてこれを使う
+        self.level = default_level(self.balance) if level is None else level
+        self.spawner = SpawnScheduler(self.level, self.rng)
+        self.precise = precise
+        self.hits = collections.Counter()  # こうかとんに当たった回数（"bombs"，"obstacles"，"items"，"jewels"）
+        self.score = Score()
+        self.item_stock = ItemStock()  # アイテム所持管理クラスのインスタンス化
+        self.cpoint = Clear_item().cpoint
+        self.cpointmax = Clear_item().cpointmax
+        self.jewel_num = Jewel_num()
+        self.bird = Bird(3, (100, HEIGHT//2))
+        self.charge_bar = ChargeBar()  # チャージバーのインスタンス
+        self.charging = False
+
+        # 描画はRenderQueueでまとめて行うので，グループは描画の機能を持たないGroupで管理する
+        self.beams = pg.sprite.Group()
+        self.exps = pg.sprite.Group()
+        self.bombs = BombArray() if bombs == "array" else BombSprites(self.broadphase)
+        self.emys = pg.sprite.Group()
+        self.shields = pg.sprite.Group()  # 防御壁グループ
+        self.emps = pg.sprite.Group()  # EMPのグループ
+        self.items = pg.sprite.Group()  # アイテムグループ
+        self.citem = pg.sprite.Group()
+        self.obstacles = pg.sprite.Group()  # 障害物グループ
+        self.gravity_group = pg.sprite.Group()  # Gravityインスタンスを管理するグループ
+
+        self.tmr = 0
+        self.result = None  # None：プレイ中，"quit"：終了，"gameover"：ゲームオーバー，"clear"：ゲームクリア
+        self.bg = None
+        self.hud = None
+        if not headless:
+            self.bg = Background([
+                BackgroundLayer(images.get("pg_bg.jpg"), images.get("pg_bg.jpg", flip=(True, False)), 3 if scroll else 0),
+            ])
+            self.hud = Hud()
+        self.queue = RenderQueue()
+        self.lifecycle = Lifecycle()
+        self.timers = TimerWheel()  # 爆弾投下・エフェクトや無敵モードの終わりなどの時刻
+        self.drops = []  # このフレームに爆弾を投下する敵機
+        self.interpolate = interpolate
+        self.prev = {}  # id(Rect) -> 直前のstepの前の左上の座標（描画の補間用）
+
+    def entity_counts(self) -> dict[str, int]:
+        """
+        グループごとのエンティティ数を返す
+        """
+        return {
+            "emys": len(self.emys),
+            "bombs": len(self.bombs),
+            "beams": len(self.beams),
+            "exps": len(self.exps),
+            "items": len(self.items),
+            "citem": len(self.citem),
+            "obstacles": len(self.obstacles),
+            "shields": len(self.shields),
+            "gravity": len(self.gravity_group),
+            "emps": len(self.emps),
+        }
+
+    def release(self):
+        """
+        すべてのエンティティを消す（プールするスプライトはプールに戻り，次のゲームで再利用される）
+        """
+        for group in (self.beams, self.exps, self.emys, self.shields, self.emps, self.items, self.citem,
+                      self.obstacles, self.gravity_group):
+            for sprite in group.sprites():
+                sprite.kill()
+        if isinstance(self.bombs, BombSprites):
+            for bomb in self.bombs.group.sprites():
+                bomb.kill()
+
+    def snapshot(self):
+        """
+        動くエンティティの今の位置を記録する（draw()で前のtickの位置として補間に使う）
+        """
+        rects = [self.bird.rect]
+        for beam in self.beams:  # 通常のビームは1つのスプライトで複数のRectを持つ
+            rects.extend(rect for _, rect in beam.blits())
+        for item in self.citem:
+            rects.extend(rect for _, rect in item.blits())
+        for group in (self.emys, self.items, self.obstacles):
+            rects.extend(sprite.rect for sprite in group)
+        if isinstance(self.bombs, BombSprites):
+            rects.extend(bomb.rect for bomb in self.bombs.group)
+        self.prev = {id(rect): (rect.x, rect.y) for rect in rects}
+        self.bombs.snapshot()
+
+    def spawn(self, rule: dict):
+        """
+        出現ルールに従って敵機・jewel・アイテム・壁を出現させる
+        引数 rule：SpawnSchedulerのルール
+        """
+        for _ in range(rule["amount"]):
+            if rule["chance"] < 1 and self.rng.random() >= rule["chance"]:
+                continue
+            if rule["type"] == "jewel":
+                self.citem.add(Clear_item(self.rng))
+            elif rule["type"] == "item":  # ランダムな種類のアイテム
+                item_type = self.rng.choice(rule.get("kinds", ["gravity", "shield", "emp", "hyper", "guided"]))
+                y = self.rng.randint(0, HEIGHT)  # y座標をランダムに設定
+                self.items.add(Item(WIDTH + 15, y, item_type))
+            elif rule["type"] == "enemy":
+                self.emys.add(Enemy(self.rng, self.balance["bomb_interval"]))
+            elif rule["type"] == "wall":  # 障害物を生成
+                self.obstacles.add(create_obstacle_wall(self.rng))
+
+    def step(self, key_lst: list[bool], events: list[pg.event.Event]):
+        """
+        入力を処理し，出現・移動・衝突判定を1フレーム（1tick）分進める
+        ゲームが終わったらself.resultに結果を設定する
+        引数1 key_lst：押下中のキーの状態（pg.key.get_pressed()と同じ形式）
+        引数2 events：このフレームのイベントのリスト
+        """
+        bird, score, item_stock, prof = self.bird, self.score, self.item_stock, self.profiler
+        beams, exps, bombs, emys = self.beams, self.exps, self.bombs, self.emys
+        if self.interpolate:
+            self.snapshot()
+        for event in events:
             if event.type == pg.QUIT:
-                return 0
+                self.result = "quit"
+                return
             if event.type == pg.KEYDOWN:
-                # if event.key == pg.K_SPACE:
-                #     beams.add(Beam(bird))
                 # アイテム使用の判定（スコア条件を削除）
                 if event.key == pg.K_RETURN:  # 重力場
                     if item_stock.use_item("gravity"):
-                        gravity_group.add(Gravity(400))
+                        self.gravity_group.add(Gravity(400, self.timers))
                 elif event.key == pg.K_s:  # 防御壁
                     if item_stock.use_item("shield"):
-                        shields.add(Shield(bird, 400))
+                        self.shields.add(Shield(bird, 400, self.timers))
                 elif event.key == pg.K_e:  # EMP
                     if item_stock.use_item("emp"):
-                        emps.add(EMP(bird, bombs, emys))
+                        self.emps.add(EMP(bird, bombs, emys, self.timers))
                 elif event.key == pg.K_RSHIFT:  # 無敵モード
                         if item_stock.use_item("hyper"):
-                            bird.state = "hyper"
-                            bird.hyper_life = 500
+                            bird.hyper(500, self.timers)
                 elif event.key == pg.K_LSHIFT:  # 誘導ビーム
                         if item_stock.use_item("guided"):
                             beams.add(GuidedBeam(bird, emys))
             if event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
-                charging = True
+                self.charging = True
             
             if event.type == pg.KEYUP and event.key == pg.K_SPACE:
-                charging = False
-                max_charged = charge_bar.charge_time == charge_bar.max_charge #チャージ時間が足りるならBEEM1を発射する
-                # if item_stock.use_item("guided"):
-                #     beams.add(GuidedBeam(bird, emys))
-                # else:
-                beams.add(Beam(bird, max_charged))
-                
-        # for event in pg.event.get():
-        #     if event.type == pg.QUIT:
-        #         return 0
-        #     if event.type == pg.KEYDOWN:  # 必ず KEYDOWN のチェックを行う
-        #         if event.key == pg.K_SPACE:
-        #             beams.add(Beam(bird))
-        #         if event.key == pg.K_s and score.value >= 50 and len(shields) == 0:
-        #             score.value -= 50  # スコアを消費
-        #             shields.add(Shield(bird, 400))  # 防御壁を生成
-        #     if event.type == pg.KEYDOWN and event.key == pg.K_RETURN and score.value >= 200:
-        #             # リターンキー押下で重力場を発動
-        #             gravity_group.add(Gravity(400))
-        #             score.value -= 200  # スコアを200減らす
-        #     if event.type == pg.KEYDOWN and event.key == pg.K_e and score.value >= 20:
-        #         score.value -= 20  # スコアを消費
-        #         emps.add(EMP(bird, bombs, emys))  # EMPを発動 
-
-        #     if key_lst[pg.K_RSHIFT] and score.value >= 100:
-        #         score.value -= 100
-        #         bird.state = "hyper"
-        #         bird.hyper_life = 500
+                self.charging = False
+                max_charged = self.charge_bar.charge_time == self.charge_bar.max_charge #チャージ時間が足りるならBEEM1を発射する
+                beams.add(Beam.acquire(bird, max_charged))
         
+        prof.mark("input")
+        # 精密モードでは矩形が重なった組だけ，画像キャッシュで共有したMaskの画素を比べる
+        collided = collide_mask if self.precise else None
         # アイテムとの衝突判定
-        for item in pg.sprite.spritecollide(bird, items, True):
+        for item in self.broadphase(self.items).spritecollide(bird, True, collided):
             item_stock.add_item(item.type)  # アイテムをストックに追加
-
-        X = tmr%3200
-        screen.blit(bg_img, [-X*3, 0])
-        screen.blit(flip_bg_img, [-X*3+1600, 0])
-        screen.blit(bg_img, [-X*3+3200, 0])
-        screen.blit(flip_bg_img, [-X*3+4800, 0])
-        screen.blit(bg_img, [-X*3+6400, 0])
-        screen.blit(flip_bg_img, [-X*3+8000, 0])
-        screen.blit(bg_img, [-X*3+9600, 0])
-        screen.blit(flip_bg_img, [-X*3+11200, 0])
-        screen.blit(bg_img, [-X*3+12800, 0])
-        screen.blit(flip_bg_img, [-X*3+14400, 0])
-        screen.blit(bg_img, [-X*3+16000, 0])
-        screen.blit(flip_bg_img, [-X*3+17600, 0])
-        
-        rand_num = random.randint(1, 5)
-        if rand_num==1 and tmr%200 == 0:
-            citem.add(Clear_item())
-
-        # ランダムなタイミングでアイテムを出現させる
-        if tmr % 300 == 0:  # 300フレームごとに
-            item_type = random.choice(["gravity", "shield", "emp", "hyper", "guided"])
-            y = random.randint(0, HEIGHT)  # y座標をランダムに設定
-            items.add(Item(WIDTH + 15, y, item_type))
-
-        if tmr%200 == 0:  # 200フレームに1回，敵機を出現させる
-            emys.add(Enemy())
-
-        if tmr % 225 == 0:  # 障害物を生成
-            obstacles.add(create_obstacle_wall())
-
-        for emy in emys:
-            if emy.state == "stop" and tmr%emy.interval == 0:
-                # 敵機が停止状態に入ったら，intervalに応じて爆弾投下
-                bombs.add(Bomb(emy, bird))
-
-        draw_charge_indicator(screen, charge_bar.charge_time == charge_bar.max_charge)
-        charge_bar.update(charging, screen)
-        bird.update(key_lst, screen)
-        # beams = [beam for beam in beams if beam.beams[0]["rct"].right > 0]
+            self.hits["items"] += 1
+
+        prof.mark("collide")
+        # 出現時刻が来たルールだけを実行する（レベルファイルまたは従来の一定間隔のルール）
+        for rule in self.spawner.due(self.tmr):
+            self.spawn(rule)
+
+        # 停止した敵機は，intervalごとのタイマーでdropsに入ったフレームに爆弾投下（敵機グループの順に投下する）
+        for emy in sorted(self.drops, key=lambda emy: emy.serial):
+            if emy.alive() and emy.armed:
+                bombs.spawn(emy, bird, self.rng, self.balance["bomb_speed"])
+        self.drops.clear()
+
+        prof.mark("spawn")
+        self.charge_bar.update(self.charging)
+        bird.update(key_lst)
         for beam in beams:
-            beam.update(screen)
-        
-        for emy in pg.sprite.groupcollide(emys, beams, True, True).keys():
-            exps.add(Explosion(emy, 100))  # 爆発エフェクト
+            beam.update()
+        prof.mark("update")
+
+        # 衝突判定の候補はグループごとにフレームで一度だけ作る
+        beam_index = self.broadphase(beams)
+        for emy in beam_index.groupcollide(emys, True, True).keys():
+            exps.add(Explosion.acquire(emy, 100, self.timers))  # 爆発エフェクト
             score.value += 10  # 10点アップ# こうかとん喜びエフェクト
 
-        for bomb in pg.sprite.groupcollide(bombs, beams, True, True).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
+        for rect, _ in bombs.collide_beams(beams):
+            exps.add(Explosion.acquire(rect, 50, self.timers))  # 爆発エフェクト
             score.value += 1  # 1点アップ
 
-        for bomb in pg.sprite.groupcollide(bombs, shields, True, False).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
+        for rect, _ in bombs.collide([shield.rect for shield in self.shields]):
+            exps.add(Explosion.acquire(rect, 50, self.timers))  # 爆発エフェクト
             score.value += 1  # 1点アップ
 
-        # 重力場と爆弾、敵機の衝突判定
-        for gravity in gravity_group:
-            for bomb in pg.sprite.spritecollide(gravity, bombs, True):
-                exps.add(Explosion(bomb, 50))  # 爆発エフェクト
-            for emy in pg.sprite.spritecollide(gravity, emys, True):
-                exps.add(Explosion(emy, 100))  # 爆発エフェクト
-
-        for bomb in pg.sprite.spritecollide(bird, bombs, True):
-            if bomb.state == "inactive":
+        # 重力場は画面全体に効くので，何枚重なっていても爆弾と敵機をグループごとまとめて1回だけ消す
+        # （画面外に出た爆弾はupdateで消えているので，矩形で画面と重なるかを調べる必要はない）
+        if self.gravity_group:
+            for rect, _ in bombs.clear():
+                exps.add(Explosion.acquire(rect, 50, self.timers))  # 爆発エフェクト
+            for emy in emys:
+                exps.add(Explosion.acquire(emy, 100, self.timers))  # 爆発エフェクト
+            emys.empty()
+
+        bird_hits = bombs.collide_mask(bird) if self.precise else bombs.collide([bird.rect])
+        self.hits["bombs"] += len(bird_hits)
+        for rect, active in bird_hits:
+            if not active:  # EMPで無効化された爆弾
                 continue
             if bird.state == "hyper":
-                exps.add(Explosion(bomb, 50))
+                exps.add(Explosion.acquire(rect, 50, self.timers))
                 score.value += 1  # 1点アップ
                 continue
             else:
                 bird.take_damage(10)
                 if bird.hp.current_hp <= 0:
-                    bird.change_img(8, screen) # こうかとん悲しみエフェクト
-                    score.update(screen)
-                    gameover(screen)
-                    pg.display.update()
-                    time.sleep(2)
+                    bird.change_img(8) # こうかとん悲しみエフェクト
+                    self.result = "gameover"
                     return
         
-        bird.hp.update(screen)
-        for item in citem: # jewelとの衝突判定
-            if bird.rect.colliderect(item.rct):
-                cpoint += 1
-                exps.add(get_efect(item, 50))
+        for item in self.citem: # jewelとの衝突判定
+            if bird.rect.colliderect(item.rct) and (collided is None or collided(bird, item)):
+                self.hits["jewels"] += 1
+                self.cpoint += 1
+                exps.add(get_efect.acquire(item, 50, self.timers))
                 score.value += 20
-                citem.remove(item)
-            for beam in beams:
-                if beam.rect.colliderect(item.rct):
-                    cpoint += 1
-                    exps.add(get_efect(item, 50))
-                    citem.remove(item)
-                    score.value += 20
-        if cpoint >= cpointmax:
-            fonto = pg.font.Font(None, 80)
-            txt = fonto.render("Game Clear", True, (0, 255, 0))
-            screen.blit(txt, [WIDTH//2-150, HEIGHT//2])
-            pg.display.update()
-            time.sleep(1)
+                self.citem.remove(item)
+            for beam in beam_index.query(item.rct):
+                self.cpoint += 1
+                exps.add(get_efect.acquire(item, 50, self.timers))
+                self.citem.remove(item)
+                score.value += 20
+        if self.cpoint >= self.cpointmax:
+            self.result = "clear"
             return
         # 障害物との衝突判定を追加
-        for obstacle in pg.sprite.spritecollide(bird, obstacles, True):
+        hits = []
+        bird_mask = images.mask(bird.image) if self.precise else None
+        for wall in self.broadphase(self.obstacles).query(bird.rect):
+            hits += wall.hit(bird.rect, bird_mask)
+        self.hits["obstacles"] += len(hits)
+        for obstacle in hits:
             if bird.state == "hyper":
-                exps.add(Explosion(obstacle, 50))
+                exps.add(Explosion.acquire(obstacle, 50, self.timers))
                 score.value += 1  # 1点アップ
                 continue
             else:
-                bird.change_img(8, screen) # こうかとん悲しみエフェクト
-                #こうかとん画像を消す
-                score.update(screen)
-                gameover(screen)
-                pg.display.update()
-                time.sleep(2)
+                bird.change_img(8) # こうかとん悲しみエフェクト
+                self.result = "gameover"
                 return
+        prof.mark("collide")
 
-
-        obstacles.update()
-        obstacles.draw(screen)
-        gravity_group.update()
-        gravity_group.draw(screen)
-        bird.update(key_lst, screen)
-        beams.update(screen)
-        # beams.draw(screen)
-        emys.update()
-        emys.draw(screen)
+        self.obstacles.update()
+        bird.update(key_lst)
+        beams.update()
+        emys.update(self.timers, self.drops)
         bombs.update()
-        bombs.draw(screen)
-        exps.update()
-        exps.draw(screen)
-        shields.update()
-        shields.draw(screen)
-        items.update()  # アイテムの更新
-        items.draw(screen)  # アイテムの描画
-        score.update(screen)
-        item_stock.draw(screen)  # アイテムの所持数を表示
-        citem.update(screen)
-        jewel_num.update(screen, cpoint)
+        self.items.update()  # アイテムの更新
+        self.citem.update()
+        # エフェクト・重力場・EMP・防御壁の消滅や無敵モードの終わりなど，このフレームの終わりが期限のタイマーを呼び出す
+        self.timers.advance()
+        # 画面外に出たままのエンティティを消し，増え続けるグループがないか確かめる
+        self.lifecycle.cull([beams, emys, exps, self.shields, self.items, self.citem, self.obstacles], self.tmr)
+        if self.lifecycle.due(self.tmr):  # 数を集めるのは記録するフレームだけ
+            self.lifecycle.check(self.entity_counts(), self.tmr)
+        prof.mark("update")
+        self.tmr += 1
+
+    def draw(self, screen: pg.Surface, updater: ScreenUpdater, alpha: float = 1.0):
+        """
+        現在の状態を画面に描画し，変化した領域をupdaterに登録する
+        引数1 screen：画面Surface
+        引数2 updater：画面更新を管理するScreenUpdater
+        引数3 alpha：直前のstepの前の位置から今の位置までの割合（1なら今の位置，interpolateがTrueのときだけ補間する）
+        """
+        if not self.interpolate:
+            alpha = 1.0
+        self.bg.draw(screen, self.tmr - 1 + alpha)
+        self.profiler.mark("background")
+        # すべてのエンティティを描画順に登録し，1回のblitsで転送する
+        queue = self.queue
+        queue.add_group(RenderQueue.OBSTACLE, self.obstacles)
+        queue.extend(RenderQueue.GRAVITY, Gravity.blits(self.gravity_group))
+        queue.extend(RenderQueue.BIRD, self.bird.blits())
+        for beam in self.beams:
+            queue.extend(RenderQueue.BEAM, beam.blits())
+        queue.add_group(RenderQueue.ENEMY, self.emys)
+        queue.extend(RenderQueue.BOMB, self.bombs.blits(alpha))
+        queue.add_group(RenderQueue.EXPLOSION, self.exps)
+        queue.add_group(RenderQueue.SHIELD, self.shields)
+        queue.add_group(RenderQueue.ITEM, self.items)  # アイテムの描画
+        for item in self.citem:
+            queue.extend(RenderQueue.JEWEL, item.blits())
+        queue.extend(RenderQueue.EMP, EMP.blits(self.emps))
+        if alpha < 1:
+            queue.interpolate(self.prev, alpha)
+        updater.add(queue.flush(screen, updater.dirty))
+
+        self.profiler.mark("draw")
+
+        # HUDは状態が変わった表示だけ描き直し，まとめて転送する
+        hud, charge_bar = self.hud, self.charge_bar
+        is_charged = charge_bar.charge_time == charge_bar.max_charge
+        hud.update("charge", is_charged, lambda surf: draw_charge_indicator(surf, is_charged))
+        hud.update("charge_bar", charge_bar.charge_time, charge_bar.draw)
+        hud.update("hp", self.bird.hp.current_hp, self.bird.hp.update)
+        hud.update("score", self.score.value, self.score.update)
+        hud.update("items", tuple(self.item_stock.items.values()), self.item_stock.draw)  # アイテムの所持数を表示
+        hud.update("jewel", self.cpoint, lambda surf: self.jewel_num.update(surf, self.cpoint))
+        updater.track(*hud.draw(screen))
+        self.profiler.mark("hud")
+
+
+class InputRecorder:
+    """
+    毎フレームのキー状態とイベントを記録し，リプレイファイルに保存するクラス
+    キー状態は変化したフレームだけをビットマスクで記録する
+    """
+    keys = (pg.K_UP, pg.K_DOWN, pg.K_LEFT, pg.K_RIGHT)  # World.stepがkey_lstから読むキー
+    event_names = {pg.QUIT: "quit", pg.KEYDOWN: "down", pg.KEYUP: "up"}
+
+    def __init__(self, seed: int):
+        """
+        引数 seed：記録するゲームの乱数シード
+        """
+        self.seed = seed
+        self.frame = 0
+        self.mask = None
+        self.key_changes = []  # [フレーム, キーのビットマスク]
+        self.events = []  # [フレーム, イベント名, キー]
+
+    def record(self, key_lst: list[bool], events: list[pg.event.Event]):
+        """
+        1フレーム分の入力を記録する（World.stepに渡す直前に呼ぶ）
+        """
+        mask = sum(1 << i for i, k in enumerate(__class__.keys) if key_lst[k])
+        if mask != self.mask:
+            self.key_changes.append([self.frame, mask])
+            self.mask = mask
+        for event in events:
+            name = __class__.event_names.get(event.type)
+            if name is not None:
+                self.events.append([self.frame, name, getattr(event, "key", 0)])
+        self.frame += 1
+
+    def save(self, path: str, world: World | None = None):
+        """
+        記録をJSONで保存する
+        引数1 path：保存先のファイル名
+        引数2 world：記録したWorld（終了時の状態を照合用に保存する）
+        """
+        data = {"seed": self.seed, "frames": self.frame, "keys": self.key_changes, "events": self.events}
+        if world is not None:
+            data["level"] = world.level
+            data["precise"] = world.precise
+            data["final"] = world_summary(world)
+        with open(path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+
+class InputReplay:
+    """
+    InputRecorderで保存したリプレイファイルから，毎フレームの入力を再生するクラス
+    """
+    event_types = {name: type for type, name in InputRecorder.event_names.items()}
+
+    def __init__(self, path: str):
+        """
+        引数 path：リプレイファイル名
+        """
+        with open(path) as f:
+            data = json.load(f)
+        self.seed = data["seed"]
+        self.frames = data["frames"]
+        self.final = data.get("final")
+        self.level = data.get("level")  # 記録時のレベル
+        self.precise = data.get("precise", False)  # 記録時の衝突判定の精密モード
+        if self.level is None:
+            print(f"warning: {path} was recorded before spawn levels; the game may not be reproduced",
+                  file=sys.stderr)
+        self.key_changes = collections.deque(data["keys"])
+        self.events = collections.deque(data["events"])
+        self.frame = 0
+        self.key_lst = collections.defaultdict(bool)
+
+    @property
+    def done(self) -> bool:
+        return self.frame >= self.frames
+
+    def next(self) -> tuple[dict, list[pg.event.Event]]:
+        """
+        次のフレームの(key_lst, events)を返す
+        """
+        if self.key_changes and self.key_changes[0][0] == self.frame:
+            mask = self.key_changes.popleft()[1]
+            self.key_lst = collections.defaultdict(bool)
+            for i, k in enumerate(InputRecorder.keys):
+                self.key_lst[k] = bool(mask >> i & 1)
+        events = []
+        while self.events and self.events[0][0] == self.frame:
+            _, name, key = self.events.popleft()
+            events.append(pg.event.Event(__class__.event_types[name], key=key))
+        self.frame += 1
+        return self.key_lst, events
+
+    def __call__(self, world: World) -> tuple[dict, list[pg.event.Event]]:
+        return self.next()
+
+
+def world_summary(world: World) -> dict:
+    """
+    リプレイの照合に使うWorldの状態をまとめて返す
+    """
+    return {
+        "tmr": world.tmr,
+        "result": world.result,
+        "score": world.score.value,
+        "hp": world.bird.hp.current_hp,
+        "jewel": world.cpoint,
+        "bird": list(world.bird.rect.topleft),
+    }
+
+
+def run_headless(frames: int, policy=None, seed: int | None = None, broadphase: str = "grid",
+                 bombs: str = "array", balance: dict | None = None, frame_ms: list[float] | None = None,
+                 level: dict | None = None, precise: bool = False) -> World:
+    """
+    SDLのダミービデオドライバ上で，描画せずフレームレートの制限もなくシミュレーションだけを進める
+    引数1 frames：進める最大フレーム数
+    引数2 policy：Worldを受け取り(key_lst, events)を返す入力関数（Noneなら無入力）
+    引数3 seed：ゲームの乱数シード
+    引数4 broadphase：衝突判定のブロードフェーズ
+    引数5 bombs：爆弾の管理方式
+    引数6 balance：World.balanceのうち変更する値
+    引数7 frame_ms：リストを渡すと，フレームごとのstep()の処理時間[ms]を追加する
+    引数8 level：出現ルールを定めるレベル（Noneなら従来のルール）
+    引数9 precise：Trueなら画素単位の衝突判定を使う
+    戻り値：終了時のWorld
+    """
+    if not pg.display.get_init():
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pg.init()
+    if pg.display.get_surface() is None:
+        pg.display.set_mode((WIDTH, HEIGHT))
+    preload_images()
+    world = World(headless=True, seed=seed, broadphase=broadphase, bombs=bombs, balance=balance, level=level,
+                  precise=precise)
+    no_input = collections.defaultdict(bool)  # どのキーも押されていない
+    for _ in range(frames):
+        key_lst, events = policy(world) if policy is not None else (no_input, [])
+        start = time.perf_counter()
+        world.step(key_lst, events)
+        if frame_ms is not None:
+            frame_ms.append((time.perf_counter() - start) * 1000)
+        if world.result is not None:
+            break
+    return world
+
+
+class FixedTimestep:
+    """
+    経過した実時間を固定の長さのtickに分け，描画のフレームレートと関係なく一定の速さでシミュレーションを進めるクラス
+    余った時間はalphaとして描画の補間に使い，処理が追いつかないときは1フレームのtick数を制限してゲームを遅くする
+    """
+    def __init__(self, rate: int = TICK_RATE, max_ticks: int = 5):
+        """
+        引数1 rate：1秒あたりのtick数
+        引数2 max_ticks：1フレームで進める最大のtick数（これを超えた分は捨てる）
+        """
+        self.dt = 1000 / rate  # 1tickの長さ[ms]
+        self.max_ticks = max_ticks
+        self.acc = 0.0  # まだシミュレーションしていない時間[ms]
+        self.ticks = 0  # 直近のフレームで進めたtick数
+        self.dropped = 0  # 追いつけずに捨てたtick数の合計
+        self.now = 0.0  # 経過時間の合計[ms]
+        self.window = collections.deque()  # 直近1秒の(時刻, tick数)
+        self.window_ticks = 0
+
+    @property
+    def alpha(self) -> float:
+        """
+        直前のtickから次のtickまでの経過の割合（0～1）
+        """
+        return self.acc / self.dt
+
+    def advance(self, elapsed: float) -> int:
+        """
+        実時間を進め，このフレームで進めるtick数を返す
+        引数 elapsed：前のフレームからの経過時間[ms]
+        """
+        self.acc += elapsed
+        ticks = int(self.acc // self.dt)
+        self.acc -= ticks * self.dt
+        if ticks > self.max_ticks:  # 追いつこうとしてさらに遅れるのを防ぐ
+            self.dropped += ticks - self.max_ticks
+            ticks = self.max_ticks
+        self.ticks = ticks
+        self.now += elapsed
+        self.window.append((self.now, ticks))
+        self.window_ticks += ticks
+        while self.window[0][0] <= self.now - 1000:
+            self.window_ticks -= self.window.popleft()[1]
+        return ticks
+
+    def stats(self) -> dict[str, int]:
+        """
+        戻り値：直近のフレームのtick数，直近1秒のtick数と描画フレーム数，捨てたtick数の合計
+        """
+        return {"ticks": self.ticks, "ticks/s": self.window_ticks, "frames/s": len(self.window),
+                "dropped": self.dropped}
+
+
+class Game:
+    """
+    画面・時計・設定・現在のWorldなど，シーンをまたいで共有する状態をまとめるクラス
+    """
+    def __init__(self, screen: pg.Surface, dirty_rects: bool = False, scroll: bool = True, seed: int | None = None,
+                 record: str | None = None, replay: InputReplay | None = None,
+                 profiler: FrameProfiler | None = None, broadphase: str = "grid", bombs: str = "array",
+                 level: dict | None = None, precise: bool = False, interpolate: bool = True):
+        """
+        引数1 screen：画面Surface
+        引数2～9，10，11，12：main()と同じ
+        """
+        self.screen = screen
+        self.updater = ScreenUpdater(dirty_rects)
+        self.scroll = scroll
+        self.seed = replay.seed if replay is not None else seed
+        self.record = record
+        self.replay = replay
+        self.profiler = FrameProfiler() if profiler is None else profiler
+        self.broadphase = broadphase
+        self.bombs = bombs
+        self.level = replay.level if replay is not None else level
+        self.precise = replay.precise if replay is not None else precise
+        self.interpolate = interpolate
+        self.world = None
+        self.recorder = None
+        self.restart_ms = None  # 直近のWorldの作り直しにかかった時間[ms]
+        self.started = time.perf_counter()
+        # 起動からの時間[ms]（"assets"：最初の画面に必要な画像の準備，"first_frame"：読み込み画面の次に表示した最初の画面，
+        # "first_play"：最初のプレイ画面）
+        self.startup = {}
+        self.preloading = None  # 画像の準備を少しずつ進めるpreload_steps()（Noneなら準備済み）
+        self.waiting = None  # preloadingの次の手順が使う画像ファイル名
+
+    def preload(self, budget_ms: float):
+        """
+        デコードの終わった画像から，画像キャッシュの準備をbudget_msの間だけ進める
+        """
+        if self.preloading is None:
+            return
+        deadline = time.perf_counter() + budget_ms / 1000
+        while time.perf_counter() < deadline:
+            if self.waiting is not None and not images.ready([self.waiting]):
+                return  # デコードが終わるまで次のフレームに回す
+            try:
+                self.waiting = next(self.preloading)
+            except StopIteration:
+                self.preloading = None
+                images.preloaded = True
+                return
+
+    def mark_startup(self, name: str) -> bool:
+        """
+        起動からの時間をself.startup[name]に一度だけ記録する
+        戻り値：今回記録したらTrue
+        """
+        if name in self.startup:
+            return False
+        self.startup[name] = (time.perf_counter() - self.started) * 1000
+        return True
+
+    def new_world(self) -> World:
+        """
+        前のゲームのエンティティをプールに戻し，読み込み済みの画像を使って新しいWorldを作る
+        """
+        start = time.perf_counter()
+        if self.world is not None:
+            self.world.release()
+        self.world = World(scroll=self.scroll, seed=self.seed, profiler=self.profiler,
+                           broadphase=self.broadphase, bombs=self.bombs, level=self.level,
+                           precise=self.precise, interpolate=self.interpolate)
+        self.recorder = InputRecorder(self.world.seed) if self.record is not None else None
+        self.restart_ms = (time.perf_counter() - start) * 1000
+        return self.world
+
+
+class Scene:
+    """
+    タイトル・プレイ中・ゲームオーバーなどの画面の基底クラス
+    どのシーンも毎tickイベントを受け取るので，待っている間もウィンドウは応答し続ける
+    状態はtick()で固定の間隔で進め，描画はrender()で画面のフレームごとに行う
+    """
+    def __init__(self, game: Game):
+        self.game = game
+
+    def enter(self):
+        """
+        このシーンに切り替わったときに一度だけ呼ばれる
+        """
+
+    def tick(self, key_lst: list[bool], events: list[pg.event.Event]) -> "Scene | None":
+        """
+        1tick分の処理を行う
+        戻り値：次のtickのシーン（Noneならゲームを終了する）
+        """
+        raise NotImplementedError
+
+    def render(self, alpha: float):
+        """
+        画面のフレームごとに描画する（静止画面のシーンはenter()で描いたままにする）
+        引数 alpha：直前のtickから次のtickまでの経過の割合
+        """
+
+
+class LoadingScene(Scene):
+    """
+    起動時の読み込み画面（最初の画面に必要な背景とこうかとんの画像のデコードが終わるまで進み具合を表示する）
+    残りの画像はデコードを続けながら，次のシーンに進んでから少しずつ準備する
+    """
+    def __init__(self, game: Game, next_scene: Scene):
+        """
+        引数1 game：共有の状態
+        引数2 next_scene：読み込みが終わったら始めるシーン
+        """
+        super().__init__(game)
+        self.next_scene = next_scene
+        self.text = CachedText(50, (255, 255, 255))
+
+    def tick(self, key_lst: list[bool], events: list[pg.event.Event]) -> Scene | None:
+        for event in events:
+            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                return None
+        if images.ready(CRITICAL_IMAGES):
+            self.game.mark_startup("assets")
+            return self.next_scene
+        return self
+
+    def render(self, alpha: float):
+        screen = self.game.screen
+        screen.fill((0, 0, 0))
+        txt = self.text.render("Loading...")
+        screen.blit(txt, txt.get_rect(center=(WIDTH//2, HEIGHT//2 - 20)))
+        bar = pg.Rect(0, 0, 400, 20)
+        bar.center = WIDTH//2, HEIGHT//2 + 30
+        pg.draw.rect(screen, (255, 255, 255), (bar.x, bar.y, round(bar.w * images.progress()), bar.h))
+        pg.draw.rect(screen, (255, 255, 255), bar, 2)
+        pg.display.update()
+
+
+class TitleScene(Scene):
+    """
+    タイトル画面（Enterキーで開始，Escキーで終了）
+    """
+    def enter(self):
+        screen = self.game.screen
+        screen.blit(images.get("pg_bg.jpg"), (0, 0))
+        for text, size, y in (("Shooting Koukaton", 100, HEIGHT//2 - 60), ("Press ENTER to start", 50, HEIGHT//2 + 40)):
+            txt = CachedText(size, (0, 0, 255)).render(text)
+            screen.blit(txt, txt.get_rect(center=(WIDTH//2, y)))
+        pg.display.update()
+
+    def tick(self, key_lst: list[bool], events: list[pg.event.Event]) -> Scene | None:
+        for event in events:
+            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                return None
+            if event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
+                return RestartScene(self.game)
+        return self
+
+
+class RestartScene(Scene):
+    """
+    新しいWorldを作ってすぐにプレイを始める（このtickのイベントはプレイ画面の最初のtickに渡す）
+    """
+    def tick(self, key_lst: list[bool], events: list[pg.event.Event]) -> Scene | None:
+        self.game.new_world()
+        if self.game.profiler.enabled:
+            print(f"restart: {self.game.restart_ms:.1f} ms", file=sys.stderr)
+        return PlayScene(self.game, events)
+
+
+class PlayScene(Scene):
+    """
+    プレイ中の画面
+    """
+    def __init__(self, game: Game, events: list[pg.event.Event] | None = None):
+        """
+        引数1 game：共有の状態
+        引数2 events：前のシーンで受け取り，最初のtickで処理するイベント（ゲーム開始と同時の終了やキー入力）
+        """
+        super().__init__(game)
+        self.carried = list(events or [])
+
+    def tick(self, key_lst: list[bool], events: list[pg.event.Event]) -> Scene | None:
+        if self.carried:
+            events, self.carried = self.carried + events, []
+        game = self.game
+        world, replay, recorder = game.world, game.replay, game.recorder
+        if replay is not None:
+            if any(event.type == pg.QUIT for event in events) or replay.done:
+                return None
+            key_lst, events = replay.next()
+        if recorder is not None:
+            recorder.record(key_lst, events)
+        world.step(key_lst, events)
+        if recorder is not None and world.result is not None:
+            recorder.save(game.record, world)
+        if world.result == "quit":
+            return None
+        if world.result in ("gameover", "clear"):
+            world.draw(game.screen, game.updater)  # 最後の状態の上に結果を表示する
+            return ResultScene(game, world.result)
+        return self
+
+    def render(self, alpha: float):
+        game = self.game
+        game.world.draw(game.screen, game.updater, alpha)
+        overlay_rect = game.profiler.draw(game.screen)
+        if overlay_rect is not None:
+            game.updater.track(overlay_rect)
+        game.updater.flush(full=game.world.bg.scrolling)
+        game.profiler.mark("display")
+
+
+class ResultScene(Scene):
+    """
+    ゲームオーバー・ゲームクリアの画面
+    決められたtick数だけ表示してからタイトルに戻る（Enterキーですぐに次のゲームを始める）
+    """
+    frames = {"gameover": 350, "clear": 50}  # 表示するtick数（7秒，1秒）
+
+    def __init__(self, game: Game, result: str):
+        """
+        引数1 game：共有の状態
+        引数2 result："gameover"または"clear"
+        """
+        super().__init__(game)
+        self.result = result
+        self.life = __class__.frames[result]
+
+    def enter(self):
+        screen = self.game.screen
+        if self.result == "gameover":
+            gameover(screen)
+        else:
+            fonto = pg.font.Font(None, 80)
+            txt = fonto.render("Game Clear", True, (0, 255, 0))
+            screen.blit(txt, [WIDTH//2-150, HEIGHT//2])
         pg.display.update()
-        tmr += 1
-        clock.tick(50)
+
+    def tick(self, key_lst: list[bool], events: list[pg.event.Event]) -> Scene | None:
+        for event in events:
+            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                return None
+            if event.type == pg.KEYDOWN and event.key == pg.K_RETURN and self.game.replay is None:
+                return RestartScene(self.game)
+        self.life -= 1
+        if self.life > 0:
+            return self
+        return TitleScene(self.game) if self.game.replay is None else None  # リプレイは1ゲームで終わる
+
+
+def main(dirty_rects: bool = False, scroll: bool = True, seed: int | None = None,
+         record: str | None = None, replay: InputReplay | None = None, profiler: FrameProfiler | None = None,
+         broadphase: str = "grid", bombs: str = "array", title: bool = True, level: dict | None = None,
+         precise: bool = False, fps: int = 60, interpolate: bool = True, max_ticks: int = 5):
+    """
+    ゲームのメインループ
+    シミュレーションはTICK_RATEの固定間隔で進め，描画は毎フレーム行ってtickの間の位置を補間する
+    引数1 dirty_rects：Trueなら変化した領域だけを画面に転送する（背景スクロール中は画面全体）
+    引数2 scroll：Falseなら背景をスクロールさせない
+    引数3 seed：ゲームの乱数シード（指定するとリスタートしても同じ展開になる）
+    引数4 record：入力を記録するリプレイファイル名
+    引数5 replay：キーボードの代わりに入力を再生するInputReplay
+    引数6 profiler：処理段階ごとの時間を計測するFrameProfiler（F3キーで表示を切り替える）
+    引数7 broadphase：衝突判定のブロードフェーズ（"grid"，"sap"，"brute"）
+    引数8 bombs：爆弾の管理方式（"array"：NumPy配列，"sprite"：スプライト）
+    引数9 title：Falseならタイトル画面を出さずに始める（リプレイ時は常に出さない）
+    引数10 level：出現ルールを定めるレベル（Noneなら従来のルール，リプレイ時は記録したレベル）
+    引数11 precise：Trueなら画素単位の衝突判定を使う（リプレイ時は記録したモード）
+    引数12 fps：描画の最大フレームレート（0なら制限しない）
+    引数13 interpolate：Falseならtickの間を補間せず，直前のtickの状態をそのまま描く
+    引数14 max_ticks：1フレームで追いつくために進める最大のtick数
+    """
+    started = time.perf_counter()
+    pg.display.set_caption("シューティングこうかとん")
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    images.load_async(image_manifest())  # デコードはスレッドプールで進め，その間も画面を更新する
+    game = Game(screen, dirty_rects, scroll, seed, record, replay, profiler, broadphase, bombs, level, precise,
+                interpolate)
+    game.started = started
+    game.preloading = preload_steps()
+    profiler = game.profiler
+    clock = pg.time.Clock()
+    timestep = FixedTimestep(TICK_RATE, max_ticks)
+    scene = TitleScene(game) if title and replay is None else RestartScene(game)
+    scene = LoadingScene(game, scene)
+    scene.enter()
+
+    elapsed = timestep.dt  # 最初のフレームで1tick進める
+    pending = []  # まだどのtickにも渡していないイベント（描画がtickより速いとき）
+    while scene is not None:
+        profiler.begin()
+        key_lst, events = pg.key.get_pressed(), pg.event.get()
+        if any(event.type == pg.KEYDOWN and event.key == pg.K_F3 for event in events):
+            profiler.toggle_overlay()  # デバッグ表示の切り替え
+        pending += events
+        profiler.mark("poll")
+        game.preload(4)  # デコードの終わった画像の準備を少しずつ進める
+        profiler.mark("assets")
+        for _ in range(timestep.advance(elapsed)):
+            next_scene = scene.tick(key_lst, pending)
+            pending = []
+            if next_scene is not scene:
+                if next_scene is not None:
+                    next_scene.enter()
+                scene = next_scene
+                if scene is None:
+                    return 0
+        scene.render(timestep.alpha)
+        # 読み込み画面の後に最初に表示した画面（タイトルかプレイ画面）までと，最初のプレイ画面までの時間を記録する
+        if not isinstance(scene, (LoadingScene, RestartScene)) and game.mark_startup("first_frame") and profiler.enabled:
+            print(f"startup: assets {game.startup['assets']:.1f} ms, "
+                  f"first frame {game.startup['first_frame']:.1f} ms", file=sys.stderr)
+        if isinstance(scene, PlayScene) and game.mark_startup("first_play") and profiler.enabled:
+            print(f"startup: first play frame {game.startup['first_play']:.1f} ms", file=sys.stderr)
+        elapsed = clock.tick(fps)
+        profiler.mark("wait")
+        if isinstance(scene, PlayScene):  # プレイ中の1フレームを最後まで処理した
+            profiler.end({**game.world.entity_counts(), "blits": game.world.queue.count,
+                          "timers": game.world.timers.fired, "bg_px": game.world.bg.pixels,
+                          "area": game.updater.area,
+                          "hud_rebuilds": game.world.hud.rebuilds, **timestep.stats()})
+    return 0
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="シューティングこうかとん")
+    parser.add_argument("--dirty", action="store_true", help="変化した領域だけを画面に転送する")
+    parser.add_argument("--static-bg", action="store_true", help="背景をスクロールさせない")
+    parser.add_argument("--headless", type=int, metavar="FRAMES", help="画面なしで指定フレーム数だけシミュレーションする")
+    parser.add_argument("--seed", type=int, help="ゲームの乱数シード")
+    parser.add_argument("--record", metavar="FILE", help="入力をリプレイファイルに記録する")
+    parser.add_argument("--replay", metavar="FILE", help="リプレイファイルの入力を再生する")
+    parser.add_argument("--broadphase", choices=BROADPHASES, default="grid", help="衝突判定のブロードフェーズ")
+    parser.add_argument("--bombs", choices=BOMB_ENGINES, default="array",
+                        help="爆弾の管理方式（array：NumPy配列でまとめて処理，sprite：スプライトごとに処理）")
+    parser.add_argument("--level", metavar="FILE", help="出現ルールを定めるレベルファイル（JSON）")
+    parser.add_argument("--precise", action="store_true",
+                        help="こうかとんの衝突判定で，矩形が重なった組の画素も比べる（透明な角では当たらない）")
+    parser.add_argument("--no-title", action="store_true", help="タイトル画面を出さずにすぐ始める")
+    parser.add_argument("--fps", type=int, default=60,
+                        help=f"描画の最大フレームレート（0なら制限しない，シミュレーションは常に{TICK_RATE}tick/秒）")
+    parser.add_argument("--no-interpolate", action="store_true", help="tickの間の位置を補間せずに描画する")
+    parser.add_argument("--profile", action="store_true", help="処理段階ごとの時間を画面に表示する（F3キーで切り替え）")
+    parser.add_argument("--profile-csv", metavar="FILE", help="処理段階ごとの時間を毎フレームCSVに書き出す")
+    args = parser.parse_args()
+    replay = InputReplay(args.replay) if args.replay else None
+    level = load_level(args.level) if args.level else None
+    if args.headless is not None:
+        start = time.perf_counter()
+        if replay is not None:
+            world = run_headless(min(args.headless, replay.frames), replay, replay.seed, args.broadphase, args.bombs,
+                                 level=replay.level, precise=replay.precise)
+        else:
+            world = run_headless(args.headless, seed=args.seed, broadphase=args.broadphase, bombs=args.bombs,
+                                 level=level, precise=args.precise)
+        elapsed = time.perf_counter() - start
+        print(f"frames={world.tmr} result={world.result} score={world.score.value} "
+              f"elapsed={elapsed:.3f}s fps={world.tmr/elapsed:.0f}")
+        if replay is not None and replay.final is not None:
+            print("replay", "matched" if world_summary(world) == replay.final else "MISMATCHED")
+        pg.quit()
+        sys.exit()
     pg.init()
-    main()
+    profiler = FrameProfiler(overlay=args.profile, csv_path=args.profile_csv)
+    main(dirty_rects=args.dirty, scroll=not args.static_bg, seed=args.seed, record=args.record, replay=replay,
+         profiler=profiler, broadphase=args.broadphase, bombs=args.bombs, title=not args.no_title, level=level,
+         precise=args.precise, fps=args.fps, interpolate=not args.no_interpolate)
+    profiler.close()
     pg.quit()
     sys.exit()